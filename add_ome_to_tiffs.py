@@ -1,21 +1,166 @@
-from typing import Literal
+from typing import Iterator, Literal, Optional
 
 import numpy as np
 import tifffile
+from tifffile import COMPRESSION
+
+import instrumentation
+from ome_tiff_writer import COMPRESSIONS, write_ome_tiff
+from tiff_readers import iter_page_slabs, probe_page_stack
+from zarr_writer import KERNELS
+
+# source compressions whose segments are valid ADOBE_DEFLATE segments
+RAW_COPY_COMPRESSIONS = (COMPRESSION.ADOBE_DEFLATE, COMPRESSION.DEFLATE)
+
+
+def _iter_pages(input_path) -> Iterator[np.ndarray]:
+    """Yield the pages of a TIFF stack one at a time, from one open file."""
+    for slab in iter_page_slabs(input_path):
+        yield slab[0]
+
+
+def _raw_copy_options(tif: tifffile.TiffFile) -> Optional[dict]:
+    """
+    Return the imwrite options reproducing the encoding of every page.
+
+    Returns None unless all pages are single-sample, deflate compressed and
+    laid out identically, in which case their strips or tiles can be copied
+    without decoding.
+
+    Parameters
+    ----------
+    tif : tifffile.TiffFile
+        Open input TIFF stack
+    """
+    first = tif.pages.first
+    layout = None
+    for page in tif.pages:
+        if (
+            page.compression not in RAW_COPY_COMPRESSIONS
+            or page.samplesperpixel != 1
+            or page.fillorder != 1
+            or 0 in page.databytecounts
+        ):
+            return None
+        page_layout = (
+            page.shape,
+            page.dtype,
+            page.predictor,
+            page.rowsperstrip,
+            page.tile,
+        )
+        if layout is None:
+            layout = page_layout
+        elif page_layout != layout:
+            return None
+    options = {
+        "shape": (len(tif.pages), *first.shape),
+        "dtype": first.dtype,
+        "byteorder": tif.byteorder,
+        "predictor": first.predictor if first.predictor != 1 else None,
+    }
+    if first.is_tiled:
+        options["tile"] = first.tile
+    else:
+        options["rowsperstrip"] = first.rowsperstrip
+    return options
+
+
+def _iter_segments(tif: tifffile.TiffFile) -> Iterator[bytes]:
+    """Yield the compressed strips or tiles of every page, in file order."""
+    fh = tif.filehandle
+    for page in tif.pages:
+        for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+            fh.seek(offset)
+            yield fh.read(bytecount)
+
+
+def _copy_segments(
+    input_path,
+    output_path,
+    metadata: dict,
+    record: Optional[instrumentation.StageRecord] = None,
+) -> bool:
+    """
+    Rewrap a deflate TIFF stack as OME-TIFF by copying its segments.
+
+    Returns False, without writing, when the input cannot be copied as is.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the input TIFF stack
+    output_path : str
+        Path where the output OME-TIFF will be saved
+    metadata : dict
+        OME metadata of the output
+    record : instrumentation.StageRecord, optional
+        Stage the segment read time is added to as read_s
+    """
+    with tifffile.TiffFile(input_path) as tif:
+        options = _raw_copy_options(tif)
+        if options is None:
+            return False
+        print(f"Copying compressed pages from {input_path}")
+        print(f"Saving OME-TIFF to {output_path}")
+        tifffile.imwrite(
+            output_path,
+            instrumentation.timed_iter(_iter_segments(tif), record, "read_s"),
+            bigtiff=True,
+            ome=True,
+            imagej=False,
+            metadata=metadata,
+            compression="ADOBE_DEFLATE",
+            **options,
+        )
+    return True
 
 
 def add_ome_metadata(
-    input_path, output_path, image_type: Literal["original", "downsampled"], dry_run: bool = False
+    input_path,
+    output_path,
+    image_type: Literal["original", "downsampled"],
+    dry_run: bool = False,
+    raw_copy: bool = True,
+    tile: Optional[tuple[int, int]] = None,
+    levels: int = 0,
+    kernel: str = "mean",
+    compression: str = "deflate",
+    compression_level: Optional[int] = None,
+    max_workers: Optional[int] = None,
 ):
     """
     Add OME metadata to an existing TIFF stack and save as OME-TIFF.
 
+    Pages are streamed one at a time. When the output keeps the default
+    deflate layout and the input is already deflate compressed, its strips
+    or tiles are copied as they are and only the OME-XML and BigTIFF
+    structure are rebuilt.
+
     Parameters
     ----------
     input_path : str
         Path to the input TIFF stack
     output_path : str
         Path where the output OME-TIFF will be saved
+    raw_copy : bool, optional
+        Copy compressed segments without re-encoding when possible
+        (default: True)
+    tile : tuple[int, int], optional
+        YX tile shape, e.g. (512, 512), instead of strips (default: None)
+    levels : int, optional
+        Number of 2x downsampled SubIFD pyramid levels (default: 0)
+    kernel : str, optional
+        Downsampling kernel of the levels, e.g. "max" for sparse masks
+        (default: "mean")
+    compression : str, optional
+        One of ome_tiff_writer.COMPRESSIONS (default: "deflate")
+    compression_level : int, optional
+        Codec compression level, which requires re-encoding (default: the
+        codec's default level)
+    max_workers : int, optional
+        Number of threads compressing the output (default: tifffile's
+        default)
     """
     if image_type == "original":
         metadata = {
@@ -37,30 +182,56 @@ def add_ome_metadata(
             "PhysicalSizeYUnit": "µm",
             "PhysicalSizeZUnit": "µm",
         }
-    if dry_run:
-        if input_path.exists():
-            print(f"DRY RUN: {input_path} exists")
-            stack = np.zeros((16, 256, 256), dtype=np.uint8)
-        else:
-            raise FileNotFoundError(f"DRY RUN: {input_path} does not exist")
-    else:
-        # Read the input TIFF stack
-        print(f"Reading TIFF stack from {input_path}")
-        stack = tifffile.imread(input_path)
+    with instrumentation.stage(
+        "add_ome_metadata", file=input_path, output=output_path
+    ) as record:
+        copied = False
+        if dry_run:
+            if input_path.exists():
+                print(f"DRY RUN: {input_path} exists")
+                shape, dtype = (16, 256, 256), np.dtype(np.uint8)
+                pages = iter(np.zeros(shape, dtype=dtype))
+            else:
+                raise FileNotFoundError(
+                    f"DRY RUN: {input_path} does not exist"
+                )
+        elif (
+            raw_copy
+            and tile is None
+            and levels == 0
+            and compression == "deflate"
+            and compression_level is None
+        ):
+            copied = _copy_segments(input_path, output_path, metadata, record)
+        if not copied:
+            if not dry_run:
+                # Stream the input TIFF stack, pages are decoded while
+                # writing
+                print(f"Reading TIFF stack from {input_path}")
+                shape, dtype = probe_page_stack(input_path)
+                pages = _iter_pages(input_path)
 
-    # Save as OME-TIFF with metadata
-    print(f"Saving OME-TIFF to {output_path}")
+            # Save as OME-TIFF with metadata
+            print(f"Saving OME-TIFF to {output_path}")
+            write_ome_tiff(
+                output_path,
+                pages,
+                shape,
+                dtype,
+                metadata,
+                tile=tile,
+                levels=levels,
+                kernel=kernel,
+                compression=compression,
+                compression_level=compression_level,
+                max_workers=max_workers,
+            )
+        if record is not None and not dry_run:
+            record.add(
+                bytes_read=instrumentation.path_bytes(input_path),
+                bytes_written=instrumentation.path_bytes(output_path),
+            )
     print(f"Image type: {image_type}")
-
-    tifffile.imwrite(
-        output_path,
-        stack,
-        bigtiff=True,
-        ome=True,
-        imagej=False,
-        metadata=metadata,
-        compression="ADOBE_DEFLATE",
-    )
     print("Done!")
 
 
@@ -85,6 +256,71 @@ if __name__ == "__main__":
         help="Dry run mode",
     )
 
+    parser.add_argument(
+        "--no-raw-copy",
+        action="store_true",
+        help="Always decode and re-encode the pages",
+    )
+    parser.add_argument(
+        "--tile",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("Y", "X"),
+        help="Write tiles of this shape, e.g. 512 512, instead of strips",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        default=0,
+        help="Number of SubIFD pyramid levels (default: 0)",
+    )
+    parser.add_argument(
+        "--kernel",
+        choices=KERNELS,
+        default="mean",
+        help="Downsampling kernel of the pyramid levels (default: mean)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="Output compression (default: deflate)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=None,
+        help="Compression level (default: the codec's default)",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="Number of compression threads",
+    )
+    parser.add_argument(
+        "--instrument",
+        type=str,
+        default=None,
+        help="Append per-stage timing and memory records to this JSON "
+        "lines file",
+    )
+
     args = parser.parse_args()
+    if args.instrument is not None:
+        instrumentation.enable(args.instrument)
 
-    add_ome_metadata(args.input_path, args.output_path, args.image_type, args.dry_run)
+    add_ome_metadata(
+        args.input_path,
+        args.output_path,
+        args.image_type,
+        args.dry_run,
+        raw_copy=not args.no_raw_copy,
+        tile=args.tile,
+        levels=args.levels,
+        kernel=args.kernel,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        max_workers=args.max_workers,
+    )
@@ -1,13 +1,161 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from typing import Iterator, Optional
+
 import numpy as np
 import tifffile
 from tqdm import tqdm
 
+import instrumentation
+from inventory import probe_tiff
+from ome_tiff_writer import COMPRESSIONS, write_ome_tiff
+from plane_sequence import PlaneSequence, z_index
+from tiff_readers import read_plane_stack, read_window, roi_window
+from tiff_validation import check_planes
+from zarr_writer import KERNELS
+
+OME_METADATA: dict = {
+    "axes": "ZYX",
+    "PhysicalSizeZ": 5.0,
+    "PhysicalSizeXUnit": "µm",
+    "PhysicalSizeYUnit": "µm",
+    "PhysicalSizeZUnit": "µm",
+    "PhysicalSizeX": 3.7,
+    "PhysicalSizeY": 3.7,
+}
+
+
+def _iter_planes(
+    tiff_files: list[Path],
+    shape: tuple,
+    dtype: np.dtype,
+    max_prefetch: int,
+    max_workers: int,
+    window: Optional[tuple[slice, slice]] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Yield the planes of `tiff_files` in Z order, decoding ahead on a pool.
 
-def aggregate_tiffs_to_ome(input_dir, output_path, pattern="*.tif", max_workers=16, dry_run=False):
+    Parameters
+    ----------
+    tiff_files : list[Path]
+        Sorted single-plane TIFF files
+    shape : tuple
+        Expected (height, width) of every plane
+    dtype : np.dtype
+        Expected dtype of every plane
+    max_prefetch : int
+        Number of planes decoded ahead of the consumer
+    max_workers : int
+        Number of threads decoding planes
+    window : tuple[slice, slice], optional
+        (y, x) window decoded from every plane (default: None, the whole
+        plane)
+    """
+    remaining = iter(tiff_files)
+    pending: deque = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(
+        total=len(tiff_files)
+    ) as progress:
+        try:
+            for tiff_file in islice(remaining, max_prefetch):
+                pending.append(
+                    (
+                        tiff_file,
+                        executor.submit(_read_plane, tiff_file, window),
+                    )
+                )
+            while pending:
+                tiff_file, future = pending.popleft()
+                plane = future.result()
+                next_file = next(remaining, None)
+                if next_file is not None:
+                    pending.append(
+                        (
+                            next_file,
+                            executor.submit(_read_plane, next_file, window),
+                        )
+                    )
+                if plane.shape != shape or plane.dtype != dtype:
+                    raise ValueError(
+                        f"{tiff_file} has shape {plane.shape} and dtype "
+                        f"{plane.dtype}, expected {shape} and {dtype}"
+                    )
+                progress.update(1)
+                yield plane
+                del plane
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _read_plane(
+    tiff_file: Path, window: Optional[tuple[slice, slice]] = None
+) -> np.ndarray:
+    if window is not None:
+        return read_window(tiff_file, window)
+    # the pool already provides the parallelism, so decode single-threaded
+    return tifffile.imread(tiff_file, maxworkers=1)
+
+
+def _subset_metadata(
+    depth: int, z_offset: int, window: tuple[slice, slice]
+) -> dict:
+    """
+    OME_METADATA with the stage position of every plane of a subset.
+
+    Parameters
+    ----------
+    depth : int
+        Number of planes of the subset
+    z_offset : int
+        Z index of the first plane of the subset in the full stack
+    window : tuple[slice, slice]
+        (y, x) window of the subset in the full planes
+    """
+    x = window[1].start * OME_METADATA["PhysicalSizeX"]
+    y = window[0].start * OME_METADATA["PhysicalSizeY"]
+    position = {
+        "PositionX": [x] * depth,
+        "PositionY": [y] * depth,
+        "PositionZ": [
+            (z_offset + z) * OME_METADATA["PhysicalSizeZ"]
+            for z in range(depth)
+        ],
+    }
+    for axis in "XYZ":
+        position[f"Position{axis}Unit"] = [
+            OME_METADATA[f"PhysicalSize{axis}Unit"]
+        ] * depth
+    return {**OME_METADATA, "Plane": position}
+
+
+def aggregate_tiffs_to_ome(
+    input_dir,
+    output_path,
+    pattern="*.tif",
+    max_workers=16,
+    dry_run=False,
+    streaming=True,
+    max_memory_mb=256,
+    tile=None,
+    levels=0,
+    kernel="mean",
+    compression="deflate",
+    compression_level=None,
+    validate=True,
+    strict=False,
+    z_range=None,
+    roi=None,
+):
     """
     Aggregate single-plane TIFF files into a single OME-TIFF file.
 
+    With a Z range or ROI, the OME metadata records the stage position of
+    every plane, so the subset keeps its place in the full stack.
+
     Parameters
     ----------
     input_dir : str
@@ -17,70 +165,135 @@ def aggregate_tiffs_to_ome(input_dir, output_path, pattern="*.tif", max_workers=
     pattern : str, optional
         Glob pattern to match the TIFF files (default: "*.tif")
     max_workers : int, optional
-        Maximum number of worker threads (default: 16)
+        Maximum number of worker threads used to decode the input planes and
+        to compress the output (default: 16)
+    dry_run : bool, optional
+        Write 16 empty planes instead of reading the input (default: False)
+    streaming : bool, optional
+        Hand planes to the writer as they are read instead of loading the
+        whole stack first (default: True)
+    max_memory_mb : float, optional
+        Upper bound on the decoded planes queued ahead of the writer while
+        streaming, at least one plane is always queued (default: 256)
+    tile : tuple[int, int], optional
+        YX tile shape, e.g. (512, 512), instead of strips (default: None)
+    levels : int, optional
+        Number of 2x downsampled SubIFD pyramid levels (default: 0)
+    kernel : str, optional
+        Downsampling kernel of the levels, e.g. "mode" for atlas labels
+        (default: "mean")
+    compression : str, optional
+        One of ome_tiff_writer.COMPRESSIONS (default: "deflate")
+    compression_level : int, optional
+        Codec compression level (default: the codec's default level)
+    validate : bool, optional
+        Check the headers and Z indices of every plane with
+        tiff_validation.check_planes before decoding any, printing the
+        anomalies found (default: True)
+    strict : bool, optional
+        Raise instead of aggregating when validation finds anomalies, e.g.
+        a missing plane (default: False)
+    z_range : tuple[int, int], optional
+        (start, stop) Z indices of the plane names to aggregate, e.g.
+        (900, 1100) (default: None, every plane)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of every plane; only the
+        strips or tiles it overlaps are decoded (default: None)
     """
-    # Get list of all TIFF files in the directory
+    write_options = {
+        "metadata": OME_METADATA,
+        "tile": tile,
+        "levels": levels,
+        "kernel": kernel,
+        "compression": compression,
+        "compression_level": compression_level,
+        "max_workers": max_workers,
+    }
+    # Get list of all TIFF files in the directory, in Z order
     input_path = Path(input_dir)
-    tiff_files = sorted(input_path.glob(pattern))
+    sequence = PlaneSequence.from_directory(input_path, pattern)
+    tiff_files = sequence.files
+    if z_range is not None:
+        tiff_files = sequence.select(*z_range)
 
     if not tiff_files:
         raise ValueError(
             f"No TIFF files found in {input_dir} matching pattern {pattern}"
         )
 
-    # Read the first image to get dimensions
-    first_image = tifffile.imread(tiff_files[0])
-    height, width = first_image.shape
+    # Read the plane headers to get dimensions
+    if validate and not dry_run:
+        facts = check_planes(tiff_files, max_workers, strict=strict)
+    else:
+        facts = probe_tiff(tiff_files[0])
+    height, width = facts["shape"]
+    dtype = np.dtype(facts["dtype"])
     depth = len(tiff_files)
+    window = None
+    subset = None
+    if z_range is not None or roi is not None:
+        subset_window = roi_window(roi, (height, width))
+        height = subset_window[0].stop - subset_window[0].start
+        width = subset_window[1].stop - subset_window[1].start
+        # the subset starts at the Z index of its first plane, the index
+        # --z_range selects by, whatever planes are missing before it
+        z_offset = z_index(tiff_files[0])
+        if z_offset is None:
+            z_offset = sequence.files.index(tiff_files[0])
+        subset = (z_offset, subset_window)
+        write_options["metadata"] = _subset_metadata(depth, *subset)
+        if roi is not None:
+            window = subset_window
 
-    # Create 3D array to hold all planes
-    stack = np.zeros((depth, height, width), dtype=first_image.dtype)
-    if not dry_run:
-    # Read all images into the stack
-        print(f"Reading {depth} TIFF files...")
-        for i, tiff_file in tqdm(enumerate(tiff_files), total=depth):
-            stack[i] = tifffile.imread(tiff_file)
-
-        # Save as OME-TIFF
-        print(f"Saving OME-TIFF to {output_path}")
-        tifffile.imwrite(
-            output_path,
-            stack,
-            bigtiff=True,
-            ome=True,
-            imagej=False,
-            metadata={
-                "axes": "ZYX",
-                "PhysicalSizeZ": 5.0,
-                "PhysicalSizeXUnit": "µm",
-                "PhysicalSizeYUnit": "µm",
-                "PhysicalSizeZUnit": "µm",
-                "PhysicalSizeX": 3.7,
-                "PhysicalSizeY": 3.7,
-            },
-            compression="ADOBE_DEFLATE",
-            maxworkers=max_workers
-        )
-    else:
-        print(f"DRY RUN: Saving OME-TIFF to {output_path}")
-        tifffile.imwrite(
-            output_path,
-            stack[:16,:,:],
-            bigtiff=True,
-            ome=True,
-            imagej=False,
-            metadata={
-                "axes": "ZYX",
-                "PhysicalSizeZ": 5.0,
-                "PhysicalSizeXUnit": "µm",
-                "PhysicalSizeYUnit": "µm",
-                "PhysicalSizeZUnit": "µm",
-                "PhysicalSizeX": 3.7,
-                "PhysicalSizeY": 3.7,
-            },
-            compression="ADOBE_DEFLATE",
-            maxworkers=max_workers
-        )
+    with instrumentation.stage(
+        "aggregate_tiffs_to_ome", file=input_dir, output=output_path
+    ) as record:
+        if dry_run:
+            print(f"DRY RUN: Saving OME-TIFF to {output_path}")
+            stack = np.zeros((min(depth, 16), height, width), dtype=dtype)
+            if subset is not None:
+                write_options["metadata"] = _subset_metadata(
+                    len(stack), *subset
+                )
+            write_ome_tiff(
+                output_path, stack, stack.shape, dtype, **write_options
+            )
+        elif streaming:
+            plane_bytes = height * width * dtype.itemsize
+            max_prefetch = max(1, int(max_memory_mb * 2**20) // plane_bytes)
+            print(f"Streaming {depth} TIFF files to {output_path}")
+            write_ome_tiff(
+                output_path,
+                _iter_planes(
+                    tiff_files,
+                    (height, width),
+                    dtype,
+                    max_prefetch,
+                    max_workers,
+                    window,
+                ),
+                (depth, height, width),
+                dtype,
+                **write_options,
+            )
+        else:
+            # Read all images into the stack
+            print(f"Reading {depth} TIFF files...")
+            with instrumentation.timer(record, "decode_s"):
+                stack = read_plane_stack(tiff_files, roi=roi).compute(
+                    scheduler="threads", num_workers=max_workers
+                )
+
+            # Save as OME-TIFF
+            print(f"Saving OME-TIFF to {output_path}")
+            write_ome_tiff(
+                output_path, stack, stack.shape, dtype, **write_options
+            )
+        if record is not None and not dry_run:
+            record.add(
+                bytes_read=instrumentation.path_bytes(*tiff_files),
+                bytes_written=instrumentation.path_bytes(output_path),
+            )
     print("Done!")
 
 
@@ -110,7 +323,103 @@ if __name__ == "__main__":
         action="store_true",
         help="Dry run mode (default: False)",
     )
+    parser.add_argument(
+        "--no_streaming",
+        action="store_true",
+        help="Load the whole stack into memory before writing (default: False)",
+    )
+    parser.add_argument(
+        "--max_memory_mb",
+        type=float,
+        default=256,
+        help="Memory ceiling for buffered planes when streaming (default: 256)",
+    )
+    parser.add_argument(
+        "--tile",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("Y", "X"),
+        help="Write tiles of this shape, e.g. 512 512, instead of strips",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        default=0,
+        help="Number of SubIFD pyramid levels (default: 0)",
+    )
+    parser.add_argument(
+        "--kernel",
+        choices=KERNELS,
+        default="mean",
+        help="Downsampling kernel of the pyramid levels (default: mean)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="Output compression (default: deflate)",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        default=None,
+        help="Compression level (default: the codec's default)",
+    )
+    parser.add_argument(
+        "--instrument",
+        type=str,
+        default=None,
+        help="Append per-stage timing and memory records to this JSON "
+        "lines file",
+    )
+    parser.add_argument(
+        "--z_range",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("START", "STOP"),
+        help="Only aggregate the planes with START <= Z index < STOP",
+    )
+    parser.add_argument(
+        "--roi",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("Y0", "Y1", "X0", "X1"),
+        help="Only aggregate this crop of every plane",
+    )
+    parser.add_argument(
+        "--no_validate",
+        action="store_true",
+        help="Skip the header and Z index check of the planes",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Abort when the header and Z index check finds anomalies "
+        "instead of printing them",
+    )
 
     args = parser.parse_args()
+    if args.instrument is not None:
+        instrumentation.enable(args.instrument)
 
-    aggregate_tiffs_to_ome(args.input_dir, args.output_path, args.pattern, args.max_workers, args.dry_run)
+    aggregate_tiffs_to_ome(
+        args.input_dir,
+        args.output_path,
+        args.pattern,
+        args.max_workers,
+        args.dry_run,
+        streaming=not args.no_streaming,
+        max_memory_mb=args.max_memory_mb,
+        tile=args.tile,
+        levels=args.levels,
+        kernel=args.kernel,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        validate=not args.no_validate,
+        strict=args.strict,
+        z_range=args.z_range,
+        roi=args.roi,
+    )
@@ -0,0 +1,420 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import dask
+import numpy as np
+import pandas as pd
+import psutil
+import tifffile
+import zarr
+
+from add_ome_to_tiffs import add_ome_metadata
+from aggregate_ome_tiffs import aggregate_tiffs_to_ome
+from conversion_cli import process_images
+from hash_compare import calculate_tiff_hash
+from instrumentation import PeakRSS
+from parse_sample_information import DERVIATIVE_SUBDIRS, parse_directories
+
+# Allen mouse brain atlas ids span roughly this range
+ATLAS_MAX_ID: int = 1400
+MASK_THRESHOLDS: tuple[int, ...] = (100, 200, 300)
+
+
+def _parse_size(text: str) -> tuple[int, int, int]:
+    """Parse "ZxYxX" into a volume shape."""
+    shape = tuple(int(part) for part in text.lower().split("x"))
+    if len(shape) != 3:
+        raise argparse.ArgumentTypeError(f"Expected ZxYxX, got {text}")
+    return shape
+
+
+def _smooth_field(
+    rng: np.random.Generator, shape: tuple, cell: int = 8
+) -> np.ndarray:
+    """Return a blocky random field in [0, 1) built on a coarse grid."""
+    coarse_shape = tuple(-(-dim // cell) for dim in shape)
+    field = rng.random(coarse_shape)
+    for axis in range(3):
+        field = np.repeat(field, cell, axis=axis)
+    return field[: shape[0], : shape[1], : shape[2]]
+
+
+def make_synthetic_sample(
+    root: Path,
+    shape: tuple[int, int, int],
+    n_labels: int = 600,
+    seed: int = 0,
+) -> dict:
+    """
+    Write a synthetic lightsheet sample laid out like the real stacks.
+
+    Creates 640_N4 uint16 planes with bright cells on a noisy background,
+    atlaslabel_def_origspace uint16 planes holding `n_labels` regions,
+    nested 0/255 640_FRST_seg masks, float32 heatmaps at half resolution,
+    the remaining derivative folders and an atlas_info_v3.csv colour table.
+
+    Parameters
+    ----------
+    root : Path
+        Sample directory to create
+    shape : tuple[int, int, int]
+        ZYX shape of the volume
+    n_labels : int, optional
+        Number of atlas regions (default: 600)
+    seed : int, optional
+        Random seed (default: 0)
+
+    Returns
+    -------
+    dict
+        Decoded size in bytes of the "image", "atlas", "masks" and
+        "heatmaps" data
+    """
+    rng = np.random.default_rng(seed)
+    depth, height, width = shape
+    for subdir in DERVIATIVE_SUBDIRS + ["heatmaps_atlasspace_corrected"]:
+        root.joinpath(subdir).mkdir(parents=True, exist_ok=True)
+
+    label_ids = rng.choice(
+        np.arange(1, ATLAS_MAX_ID), size=n_labels, replace=False
+    )
+    atlas = label_ids[
+        (_smooth_field(rng, shape, cell=16) * n_labels).astype(int)
+    ].astype(np.uint16)
+    # background outside the brain
+    atlas[:, :, : width // 8] = 0
+    for z in range(depth):
+        plane = rng.normal(300, 30, (height, width))
+        cells = rng.random((height, width)) < 0.002
+        plane[cells] = rng.uniform(2000, 4000, cells.sum())
+        tifffile.imwrite(
+            root.joinpath("640_N4", f"Z{z:04d}.tif"),
+            np.clip(plane, 0, 65535).astype(np.uint16),
+        )
+        tifffile.imwrite(
+            root.joinpath("atlaslabel_def_origspace", f"Z{z:04d}.tif"),
+            atlas[z],
+        )
+        tifffile.imwrite(
+            root.joinpath("640_FRST", f"Z{z:04d}.tif"), np.zeros(1, np.uint8)
+        )
+    # higher thresholds keep a subset of the cells, as process_images
+    # expects when folding the masks
+    response = _smooth_field(rng, shape, cell=4)
+    for threshold in MASK_THRESHOLDS:
+        tifffile.imwrite(
+            root.joinpath("640_FRST_seg", f"FRSTseg_{threshold:04d}.tif"),
+            ((response > 0.9 + threshold / 4000) * 255).astype(np.uint8),
+            photometric="minisblack",
+        )
+    heatmap_shape = (max(1, depth // 2), height // 2, width // 2)
+    for threshold in MASK_THRESHOLDS:
+        for subdir in ("heatmaps_atlasspace", "heatmaps_atlasspace_corrected"):
+            tifffile.imwrite(
+                root.joinpath(subdir, f"heatmap_{threshold:04d}.tif"),
+                (rng.random(heatmap_shape) * threshold).astype(np.float32),
+                photometric="minisblack",
+            )
+
+    atlas_df = pd.DataFrame(
+        {
+            "id": label_ids,
+            "red": rng.integers(0, 256, n_labels),
+            "green": rng.integers(0, 256, n_labels),
+            "blue": rng.integers(0, 256, n_labels),
+        }
+    )
+    atlas_df.to_csv(root.parent.joinpath("atlas_info_v3.csv"), index=False)
+    voxels = depth * height * width
+    return {
+        "image": voxels * 2,
+        "atlas": voxels * 2,
+        "masks": voxels * len(MASK_THRESHOLDS),
+        "heatmaps": int(np.prod(heatmap_shape)) * 4 * len(MASK_THRESHOLDS),
+    }
+
+
+def make_sample_tree(root: Path, n_samples: int, n_planes: int) -> None:
+    """
+    Create a KO group directory of `n_samples` sample directories.
+
+    Every derivative folder holds `n_planes` empty placeholder planes, so
+    walking the tree costs what walking the real one does.
+
+    Parameters
+    ----------
+    root : Path
+        Directory the "KO" group directory is created in
+    n_samples : int
+        Number of sample directories
+    n_planes : int
+        Placeholder files per derivative folder
+    """
+    group = root.joinpath("KO")
+    for i in range(n_samples):
+        sample_dir = group.joinpath(
+            f"_4{i:04d}_LH_ko", f"210810_4{i:04d}_ko_female_LH_decon"
+        )
+        for subdir in DERVIATIVE_SUBDIRS + ["heatmaps_atlasspace_corrected"]:
+            subdir_path = sample_dir.joinpath(subdir)
+            subdir_path.mkdir(parents=True)
+            for z in range(n_planes):
+                subdir_path.joinpath(f"Z{z:04d}.tif").touch()
+
+
+def time_stage(
+    stage: str, func: Callable, n_bytes: int = 0, repeat: int = 1
+) -> dict:
+    """
+    Run a stage `repeat` times and report its best wall time.
+
+    The memory of a stage is its largest RSS growth over the RSS at the
+    start of a run, so the memory earlier stages left allocated is not
+    counted again.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage
+    func : Callable
+        Function running the stage once, it must clean up after itself
+    n_bytes : int, optional
+        Decoded bytes processed by one run, for the throughput (default: 0)
+    repeat : int, optional
+        Number of runs (default: 1)
+    """
+    wall_times = []
+    rss_growth = 0
+    for _ in range(repeat):
+        gc.collect()
+        with PeakRSS() as memory:
+            start = time.perf_counter()
+            func()
+            wall_times.append(time.perf_counter() - start)
+        rss_growth = max(rss_growth, memory.growth_bytes)
+    wall = min(wall_times)
+    return {
+        "stage": stage,
+        "wall_s": wall,
+        "MB": n_bytes / 2**20,
+        "MBps": n_bytes / 2**20 / wall if n_bytes else None,
+        "rss_growth_MB": rss_growth / 2**20,
+    }
+
+
+def _unlink_after(func: Callable, *outputs: Path) -> Callable:
+    """Wrap a stage so its outputs are removed after every run."""
+
+    def run() -> None:
+        try:
+            func()
+        finally:
+            for output in outputs:
+                if output.is_dir():
+                    shutil.rmtree(output)
+                else:
+                    output.unlink(missing_ok=True)
+
+    return run
+
+
+def benchmark_size(
+    work_dir: Path,
+    shape: tuple[int, int, int],
+    repeat: int = 1,
+    n_samples: int = 20,
+) -> list[dict]:
+    """
+    Time every pipeline stage on a synthetic sample of one size.
+
+    Parameters
+    ----------
+    work_dir : Path
+        Empty directory the data and outputs are written to
+    shape : tuple[int, int, int]
+        ZYX shape of the synthetic volume
+    repeat : int, optional
+        Runs per stage, the best is reported (default: 1)
+    n_samples : int, optional
+        Sample directories walked by parse_directories (default: 20)
+    """
+    sample = work_dir.joinpath("samples", "sample")
+    print(f"Creating a {'x'.join(map(str, shape))} synthetic sample...")
+    sizes = make_synthetic_sample(sample, shape)
+    make_sample_tree(work_dir, n_samples, shape[0])
+    print("...done!")
+
+    mask_file = sample.joinpath("640_FRST_seg", "FRSTseg_0100.tif")
+    deflate_mask_file = work_dir.joinpath("FRSTseg_0100_deflate.tif")
+    tifffile.imwrite(
+        deflate_mask_file,
+        tifffile.imread(mask_file),
+        photometric="minisblack",
+        compression="zlib",
+    )
+    mask_bytes = sizes["masks"] // len(MASK_THRESHOLDS)
+    plane_files = sorted(sample.joinpath("640_N4").glob("*.tif"))
+    ome_output = work_dir.joinpath("output.ome.tif")
+    stages = [
+        (
+            "aggregate_tiffs_to_ome",
+            lambda: aggregate_tiffs_to_ome(
+                sample.joinpath("640_N4"), ome_output
+            ),
+            sizes["image"],
+            [ome_output],
+        ),
+        (
+            "aggregate_tiffs_to_ome_tiled",
+            lambda: aggregate_tiffs_to_ome(
+                sample.joinpath("640_N4"),
+                ome_output,
+                tile=(512, 512),
+                levels=3,
+            ),
+            sizes["image"],
+            [ome_output],
+        ),
+        (
+            "add_ome_metadata",
+            lambda: add_ome_metadata(mask_file, ome_output, "original"),
+            mask_bytes,
+            [ome_output],
+        ),
+        (
+            "add_ome_metadata_raw_copy",
+            lambda: add_ome_metadata(
+                deflate_mask_file, ome_output, "original"
+            ),
+            mask_bytes,
+            [ome_output],
+        ),
+        (
+            "process_images",
+            lambda: process_images(str(sample)),
+            sum(sizes.values()),
+            [
+                sample.joinpath("sample.zarr"),
+                sample.joinpath("sample_heatmaps.zarr"),
+            ],
+        ),
+        (
+            "process_images_fold_masks",
+            lambda: process_images(str(sample), fold_masks=True),
+            sum(sizes.values()),
+            [
+                sample.joinpath("sample.zarr"),
+                sample.joinpath("sample_heatmaps.zarr"),
+            ],
+        ),
+        (
+            "calculate_tiff_hash",
+            lambda: [calculate_tiff_hash(f) for f in plane_files],
+            sizes["image"],
+            [],
+        ),
+        (
+            "parse_directories",
+            lambda: parse_directories(work_dir.joinpath("KO")),
+            0,
+            [],
+        ),
+    ]
+    results = []
+    # process_images reads atlas_info_v3.csv from the working directory
+    with contextlib.chdir(sample.parent):
+        for stage, func, n_bytes, outputs in stages:
+            print(f"Benchmarking {stage}...")
+            result = time_stage(
+                stage, _unlink_after(func, *outputs), n_bytes, repeat
+            )
+            result["shape"] = "x".join(str(dim) for dim in shape)
+            results.append(result)
+    return results
+
+
+def environment() -> dict:
+    """Describe the machine and library versions of a benchmark run."""
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "memory_GB": psutil.virtual_memory().total / 2**30,
+        "numpy": np.__version__,
+        "tifffile": tifffile.__version__,
+        "zarr": zarr.__version__,
+        "dask": dask.__version__,
+    }
+
+
+def main():
+    """
+    Benchmark the conversion and packaging pipelines on synthetic data.
+    """
+    parser = argparse.ArgumentParser(
+        description="Time the conversion and packaging stages on synthetic "
+        "lightsheet data and save the results as JSON."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=_parse_size,
+        nargs="+",
+        default=[(32, 512, 512), (64, 1024, 1024)],
+        help="ZxYxX volume sizes (default: 32x512x512 64x1024x1024)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs per stage, the best is reported (default: 1)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=20,
+        help="Sample directories walked by parse_directories (default: 20)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="Directory the synthetic data is written to, ideally on the "
+        "storage the real data lives on",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="benchmark_results.json",
+        help="Results JSON file (default: benchmark_results.json)",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for shape in args.sizes:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp:
+            results += benchmark_size(
+                Path(tmp), shape, args.repeat, args.samples
+            )
+    print(
+        pd.DataFrame(results).to_string(index=False, float_format="%.2f")
+    )
+    with open(args.output, "w") as f:
+        json.dump(
+            {"environment": environment(), "results": results}, f, indent=2
+        )
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
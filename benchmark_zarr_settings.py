@@ -0,0 +1,204 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import zarr
+from tqdm import tqdm
+
+from tiff_readers import read_plane_stack
+from zarr_writer import make_storage_options
+
+
+def directory_size(path: Path) -> int:
+    """Return the total size in bytes of the files below a directory."""
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _parse_chunks(text: str) -> tuple[int, int, int]:
+    """Parse "Z,Y,X" into a chunk shape."""
+    chunks = tuple(int(part) for part in text.split(","))
+    if len(chunks) != 3:
+        raise argparse.ArgumentTypeError(
+            f"Expected Z,Y,X chunks, got {text}"
+        )
+    return chunks
+
+
+def _parse_compressor(text: str) -> dict:
+    """Parse "cname:clevel:shuffle", e.g. "zstd:5:bitshuffle"."""
+    parts = text.split(":")
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(
+            f"Expected cname:clevel:shuffle, got {text}"
+        )
+    return {"cname": parts[0], "clevel": int(parts[1]), "shuffle": parts[2]}
+
+
+def read_latency_ms(
+    array: zarr.Array, orientation: str, samples: int, seed: int = 0
+) -> float:
+    """
+    Return the mean time in ms to read one full slice of a ZYX array.
+
+    Parameters
+    ----------
+    array : zarr.Array
+        ZYX array to read from
+    orientation : str
+        "xy", "xz" or "yz"
+    samples : int
+        Number of random slices read
+    seed : int, optional
+        Seed of the slice positions (default: 0)
+    """
+    axis = {"xy": 0, "xz": 1, "yz": 2}[orientation]
+    rng = np.random.default_rng(seed)
+    positions = rng.integers(0, array.shape[axis], samples)
+    start = time.perf_counter()
+    for position in positions:
+        index = [slice(None)] * 3
+        index[axis] = int(position)
+        array[tuple(index)]
+    return (time.perf_counter() - start) / samples * 1000
+
+
+def benchmark_settings(
+    volume: np.ndarray,
+    chunk_shapes: Sequence[tuple[int, int, int]],
+    compressors: Sequence[dict],
+    samples: int = 10,
+    work_dir: Optional[Path] = None,
+) -> pd.DataFrame:
+    """
+    Write a volume with every combination of chunks and compressor.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        ZYX sample volume
+    chunk_shapes : Sequence[tuple[int, int, int]]
+        Candidate ZYX chunk shapes
+    compressors : Sequence[dict]
+        Candidate make_storage_options compressor arguments
+    samples : int, optional
+        Slices read per orientation (default: 10)
+    work_dir : Path, optional
+        Directory the candidate stores are written to, ideally on the
+        storage the real outputs go to (default: a temporary directory)
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per candidate with the write throughput in MB/s, the size
+        on disk, the compression ratio and the read latency per orientation
+    """
+    rows = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        candidates = [
+            (chunks, compressor)
+            for chunks in chunk_shapes
+            for compressor in compressors
+        ]
+        for index, (chunks, compressor) in enumerate(tqdm(candidates)):
+            options = make_storage_options(chunks, **compressor)
+            store_path = Path(tmp, f"candidate_{index}.zarr")
+            array = zarr.open_array(
+                str(store_path),
+                mode="w",
+                shape=volume.shape,
+                dtype=volume.dtype,
+                **options,
+            )
+            start = time.perf_counter()
+            array[:] = volume
+            write_seconds = time.perf_counter() - start
+            size = directory_size(store_path)
+            row = {
+                "chunks": "x".join(str(chunk) for chunk in chunks),
+                "compressor": f"{compressor['cname']}:{compressor['clevel']}"
+                f":{compressor['shuffle']}",
+                "write_MBps": volume.nbytes / 2**20 / write_seconds,
+                "size_MB": size / 2**20,
+                "ratio": volume.nbytes / size,
+            }
+            for orientation in ("xy", "xz", "yz"):
+                row[f"read_{orientation}_ms"] = read_latency_ms(
+                    array, orientation, samples
+                )
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    """
+    Benchmark OME-Zarr chunk and compressor settings on a sample volume.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark zarr chunk shapes and compressors on a "
+        "directory of single-plane TIFF files."
+    )
+    parser.add_argument(
+        "input_dir", type=str, help="Directory of single-plane TIFF files"
+    )
+    parser.add_argument(
+        "--pattern", type=str, default="*.tif", help="Plane glob pattern"
+    )
+    parser.add_argument(
+        "--max-planes",
+        type=int,
+        default=128,
+        help="Number of planes loaded as the sample volume (default: 128)",
+    )
+    parser.add_argument(
+        "--chunks",
+        type=_parse_chunks,
+        nargs="+",
+        default=[(16, 512, 512), (64, 256, 256), (128, 128, 128)],
+        help="Candidate Z,Y,X chunk shapes",
+    )
+    parser.add_argument(
+        "--compressors",
+        type=_parse_compressor,
+        nargs="+",
+        default=[
+            _parse_compressor("zstd:5:bitshuffle"),
+            _parse_compressor("lz4:5:bitshuffle"),
+            _parse_compressor("lz4:5:shuffle"),
+        ],
+        help="Candidate cname:clevel:shuffle Blosc settings",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=10,
+        help="Slices read per orientation (default: 10)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="Directory the candidate stores are written to",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Optional results CSV"
+    )
+    args = parser.parse_args()
+
+    stack = read_plane_stack(args.input_dir, args.pattern)
+    print("Reading the sample volume...")
+    volume = stack[: args.max_planes].compute(scheduler="threads")
+    print("...done!")
+    results = benchmark_settings(
+        volume, args.chunks, args.compressors, args.samples, args.work_dir
+    )
+    print(results.to_string(index=False, float_format="%.2f"))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
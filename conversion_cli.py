@@ -1,19 +1,270 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Generator
+from typing import Iterator, Optional
 import argparse
+import json
 
 import dask.array as da
 import numpy as np
 import pandas as pd
-import tifffile as tf
 import zarr
 from matplotlib import pyplot as plt
 from ome_zarr.io import parse_url
-from ome_zarr.writer import write_image
 from tqdm import tqdm
 
+import instrumentation
+from inventory import InventoryIndex, probe_tiff
+from plane_sequence import PlaneSequence, z_index
+from image_statistics import (
+    LABEL_BINS,
+    block_label_counts,
+    block_statistics,
+    compute_statistics,
+    finalize_statistics,
+    merge_statistics,
+)
+from tiff_readers import (
+    ROI,
+    iter_page_slabs,
+    probe_page_stack,
+    read_page_stack,
+    read_plane_stack,
+    roi_window,
+)
+from tiff_validation import check_planes
+from zarr_writer import (
+    KERNELS,
+    build_pyramid,
+    create_pyramid,
+    make_storage_options,
+    write_pyramid_metadata,
+    write_slab,
+    write_slabs,
+)
 
-def process_images(stacks_root: str):
+# layers of process_images that take their own storage options
+STORAGE_LAYERS: tuple[str, ...] = ("image", "atlas", "mask", "heatmap")
+
+
+def _stored_bytes(group: zarr.Group) -> int:
+    """Return the bytes stored under `group` in its directory store."""
+    return instrumentation.path_bytes(Path(group.store.path, group.path))
+
+
+def _find_tiffs(
+    directory: Path, recursive: bool, index: Optional[InventoryIndex] = None
+) -> list[Path]:
+    """Return the sorted TIFF files of a directory, from `index` if given."""
+    if index is not None:
+        return sorted(index.glob(directory, "*.tif", recursive=recursive))
+    if recursive:
+        return sorted(directory.rglob("*.tif"))
+    return sorted(directory.glob("*.tif"))
+
+
+def _iter_slabs(
+    stack: da.Array, slab_depth: int
+) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Yield (z_start, slab) blocks of `slab_depth` planes of a lazy ZYX stack.
+
+    Parameters
+    ----------
+    stack : da.Array
+        Lazy ZYX stack, e.g. from read_plane_stack or read_page_stack
+    slab_depth : int
+        Number of planes per slab
+    """
+    for z_start in tqdm(range(0, stack.shape[0], slab_depth)):
+        yield z_start, stack[z_start : z_start + slab_depth].compute()
+
+
+def _fold_mask_slabs(
+    mask_files: list[Path],
+    slab_depth: int,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Yield slabs holding the rank of the highest threshold mask passed.
+
+    Parameters
+    ----------
+    mask_files : list[Path]
+        Multi-page binary masks of the same shape, in increasing threshold
+        order, each nested in the previous one
+    slab_depth : int
+        Number of planes per slab
+    page_range : tuple[int, int], optional
+        (start, stop) pages of a subset (default: None, every page)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of a subset (default: None)
+    """
+    # every mask is streamed from its own open file, in step
+    mask_slabs = zip(
+        *(
+            iter_page_slabs(mask_file, slab_depth, np.uint8, page_range, roi)
+            for mask_file in mask_files
+        )
+    )
+    depth = probe_page_stack(mask_files[0], page_range=page_range)[0][0]
+    for slab_idx, slabs in enumerate(
+        tqdm(mask_slabs, total=-(-depth // slab_depth))
+    ):
+        folded = None
+        previous = None
+        for rank, slab in enumerate(slabs, start=1):
+            passed = slab > 0
+            if folded is None:
+                folded = np.zeros(passed.shape, dtype=np.uint8)
+            elif np.any(passed & ~previous):
+                raise ValueError(
+                    f"{mask_files[rank - 1].name} is not nested in "
+                    f"{mask_files[rank - 2].name} near plane "
+                    f"{slab_idx * slab_depth}"
+                )
+            folded[passed] = rank
+            previous = passed
+        yield folded
+
+
+def _write_mask(
+    mask_file: Path,
+    mask_grp: zarr.Group,
+    kernel: str,
+    storage_options: dict,
+    max_layer: int = 4,
+    downscale: int = 2,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+    translation: Optional[tuple[int, int, int]] = None,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Write one FRSTseg threshold mask as a multiscale label image.
+
+    Parameters
+    ----------
+    mask_file : Path
+        Multi-page 0/255 mask TIFF
+    mask_grp : zarr.Group
+        Label group of the threshold
+    kernel : str
+        Downsampling kernel of the pyramid
+    storage_options : dict
+        Chunks and compressor from zarr_writer.make_storage_options
+    max_layer : int, optional
+        Number of downsampled pyramid levels (default: 4)
+    downscale : int, optional
+        YX reduction factor between pyramid levels (default: 2)
+    page_range : tuple[int, int], optional
+        (start, stop) pages of a subset (default: None, every page)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of a subset (default: None)
+    translation : tuple[int, int, int], optional
+        ZYX origin of a subset in full resolution voxels (default: None)
+    max_workers : int, optional
+        Number of threads building each pyramid level (default:
+        ThreadPoolExecutor's default)
+    """
+    with instrumentation.stage(
+        "process_images.mask", file=mask_file, output=mask_grp.path
+    ) as record:
+        mask_shape, _ = probe_page_stack(
+            mask_file, page_range=page_range, roi=roi
+        )
+        write_slabs(
+            iter_page_slabs(
+                mask_file,
+                storage_options["chunks"][0],
+                np.uint8,
+                page_range,
+                roi,
+            ),
+            mask_grp,
+            mask_shape,
+            np.uint8,
+            axes="zyx",
+            max_layer=max_layer,
+            downscale=downscale,
+            kernel=kernel,
+            translation=translation,
+            max_workers=max_workers,
+            **storage_options,
+        )
+        if record is not None:
+            record.add(
+                bytes_read=instrumentation.path_bytes(mask_file),
+                bytes_written=_stored_bytes(mask_grp),
+            )
+
+
+def _write_heatmap_channel(
+    arrays: list[zarr.Array],
+    heatmap_file: Path,
+    channel: int,
+    scaler: np.float32,
+    downscale: int = 2,
+) -> None:
+    """
+    Scale one heatmap threshold to uint16 and write it slab by slab.
+
+    Parameters
+    ----------
+    arrays : list[zarr.Array]
+        CZYX pyramid levels of the heatmap image
+    heatmap_file : Path
+        Multi-page float32 ZYX heatmap of the threshold
+    channel : int
+        Index of the threshold along the C axis
+    scaler : np.float32
+        Factor mapping the global heatmap maximum to 65535
+    downscale : int, optional
+        YX reduction factor between pyramid levels (default: 2)
+    """
+    record = instrumentation.current()
+    slab_depth = arrays[0].chunks[-3]
+    slabs = instrumentation.timed_iter(
+        iter_page_slabs(heatmap_file, slab_depth, np.float32),
+        record,
+        "decode_s",
+    )
+    z_start = 0
+    for slab in slabs:
+        with instrumentation.timer(record, "encode_s"):
+            np.multiply(slab, scaler, out=slab)
+            np.round(slab, out=slab)
+            # nearest neighbour, as write_image used for the numpy heatmap
+            write_slab(
+                arrays,
+                slab.astype(np.uint16),
+                z_start,
+                leading=(channel,),
+                downscale=downscale,
+                kernel="nearest",
+            )
+        z_start += slab.shape[0]
+
+
+def process_images(
+    stacks_root: str,
+    window_percentiles: tuple[float, float] = (0.0, 100.0),
+    max_layer: int = 4,
+    downscale: int = 2,
+    image_kernel: str = "mean",
+    atlas_kernel: str = "mode",
+    mask_kernel: str = "max",
+    storage_options: Optional[dict[str, dict]] = None,
+    fold_masks: bool = False,
+    index: Optional[InventoryIndex] = None,
+    validate: bool = True,
+    strict: bool = False,
+    z_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+    max_workers: Optional[int] = None,
+):
     """
     Process the N4 deconned images as the primary images in the zarr directory.
 
@@ -21,7 +272,64 @@ def process_images(stacks_root: str):
     ----------
     stacks_root : str
         The root directory containing the image stacks.
+    window_percentiles : tuple[float, float], optional
+        Percentiles of the image intensities used as the omero window start
+        and end, e.g. (0.1, 99.9) for a robust window (default: (0.0, 100.0),
+        the minimum and maximum).
+    max_layer : int, optional
+        Number of downsampled pyramid levels (default: 4).
+    downscale : int, optional
+        YX reduction factor between pyramid levels (default: 2).
+    image_kernel : str, optional
+        Downsampling kernel of the c-Fos image (default: "mean").
+    atlas_kernel : str, optional
+        Downsampling kernel of the atlas regions, which must keep valid
+        label ids (default: "mode").
+    mask_kernel : str, optional
+        Downsampling kernel of the FRSTseg masks, "max" keeps sparse cells
+        visible at coarse levels (default: "max").
+    storage_options : dict[str, dict], optional
+        Chunks and compressor per layer of STORAGE_LAYERS, each a dict from
+        zarr_writer.make_storage_options; missing layers use its defaults
+        (default: None).
+    fold_masks : bool, optional
+        Store the nested FRSTseg masks as one "FRSTseg" label volume holding
+        the rank of the highest threshold passed, instead of one 0/255
+        volume per threshold. The "FRSTseg {threshold}" groups then only
+        hold the rank their mask is recovered from, as ``volume >= rank``
+        (default: False).
+    index : InventoryIndex, optional
+        Inventory the TIFF files are listed from instead of the filesystem
+        (default: None).
+    validate : bool, optional
+        Check the headers and Z indices of the image and atlas planes with
+        tiff_validation.check_planes before anything is written, printing
+        the anomalies found (default: True).
+    strict : bool, optional
+        Raise instead of converting when validation finds anomalies, e.g.
+        a missing plane (default: False).
+    z_range : tuple[int, int], optional
+        (start, stop) Z indices of the c-Fos plane names to convert, e.g.
+        (900, 1100); the atlas planes and mask pages at the same positions
+        are converted along (default: None, every plane).
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of the image, atlas and
+        mask planes; only the strips or tiles it overlaps are decoded
+        (default: None).
+    max_workers : int, optional
+        Threads building the pyramids, shared by the FRSTseg masks written
+        concurrently, and bound on the heatmap channels written
+        concurrently (default: os.cpu_count()).
+
+    With a Z range or ROI, the image and label multiscales record the
+    origin of the subset as a translation. The heatmaps are in the 25 µm
+    atlas space, not the image space, and are always converted whole.
     """
+    storage_options = {
+        layer: (storage_options or {}).get(layer, make_storage_options())
+        for layer in STORAGE_LAYERS
+    }
+    max_workers = max_workers or os.cpu_count() or 1
     stacks_root_path: Path = Path(stacks_root)
     image_subdir: Path = stacks_root_path.joinpath(r"640_N4")
     atlas_subdir: Path = stacks_root_path.joinpath(r"atlaslabel_def_origspace")
@@ -57,6 +365,39 @@ def process_images(stacks_root: str):
             f"Atlas color map file does not exist: {atlas_color_map}"
         )
 
+    # planes in Z order, whatever their zero-padding
+    image_sequence = PlaneSequence(_find_tiffs(image_subdir, True, index))
+    sorted_deconned_images: list = image_sequence.files
+    sorted_atlas_images: list = PlaneSequence(
+        _find_tiffs(atlas_subdir, True, index)
+    ).files
+    # the positions of the subset planes select the atlas planes and the
+    # mask pages too
+    page_range = None
+    translation = None
+    if z_range is not None or roi is not None:
+        selected = image_sequence.select(*(z_range or (None, None)))
+        if not selected:
+            raise ValueError(f"No c-Fos planes in Z range {z_range}")
+        first = sorted_deconned_images.index(selected[0])
+        page_range = (first, first + len(selected))
+        sorted_deconned_images = selected
+        sorted_atlas_images = sorted_atlas_images[slice(*page_range)]
+        window = roi_window(
+            roi, tuple(probe_tiff(sorted_deconned_images[0])["shape"])
+        )
+        # the origin is the Z index of the first plane, the index --z-range
+        # selects by, whatever planes are missing before it
+        z_offset = z_index(selected[0])
+        if z_offset is None:
+            z_offset = first
+        translation = (z_offset, window[0].start, window[1].start)
+    if validate:
+        # report (or in strict mode fail) before the stores are overwritten,
+        # not hours into the run
+        check_planes(sorted_deconned_images, index=index, strict=strict)
+        check_planes(sorted_atlas_images, index=index, strict=strict)
+
     store = parse_url(
         stacks_root_path.joinpath(stacks_root_path.name + ".zarr"), mode="w"
     ).store
@@ -69,40 +410,57 @@ def process_images(stacks_root: str):
 
     # Process the N4 deconned images as the primary images in the zarr directory
     root = zarr.group(store=store)
-    deconned_images: Generator = image_subdir.rglob("*.tif")
-    sorted_deconned_images: list = sorted(list(deconned_images))
-    with tf.TiffFile(sorted_deconned_images[0]) as tif:
-        y_dim, x_dim = tif.pages[0].shape
-    print("Creating the dask array...")
-    total_array = da.zeros(
-        (len(sorted_deconned_images), y_dim, x_dim), dtype=da.uint16
+    image_stack = read_plane_stack(
+        sorted_deconned_images, dtype=np.uint16, roi=roi
     )
-    print("...done!")
-    min_value = da.uint16((2**16) - 1)
-    max_value = da.uint16(0)
-    for i, deconned_image in tqdm(
-        enumerate(sorted_deconned_images), total=len(sorted_deconned_images)
-    ):
-        with tf.TiffFile(deconned_image) as tif:
-            tif_array = tif.asarray()
-            if tif_array.min() < min_value:
-                min_value = tif_array.min()
-            if tif_array.max() > max_value:
-                max_value = tif_array.max()
-            total_array[i, :, :] = tif_array
-    write_image(
-        image=total_array,
-        group=root,
-        axes="zyx",
+    with instrumentation.stage(
+        "process_images.image", file=image_subdir
+    ) as record:
+        print("Creating the zarr arrays...")
+        image_arrays = create_pyramid(
+            root,
+            image_stack.shape,
+            np.uint16,
+            max_layer=max_layer,
+            downscale=downscale,
+            **storage_options["image"],
+        )
+        print("...done!")
+        # the intensity histogram is accumulated while the slabs are written
+        image_statistics = None
+        for z_start, slab in instrumentation.timed_iter(
+            _iter_slabs(image_stack, image_arrays[0].chunks[0]),
+            record,
+            "decode_s",
+        ):
+            image_statistics = merge_statistics(
+                image_statistics, block_statistics(slab)
+            )
+            with instrumentation.timer(record, "encode_s"):
+                write_slab(image_arrays[:1], slab, z_start)
+        print("Building the image pyramid...")
+        with instrumentation.timer(record, "encode_s"):
+            build_pyramid(
+                image_arrays, image_kernel, downscale, max_workers
+            )
+        write_pyramid_metadata(root, image_arrays, "zyx", translation)
+        if record is not None:
+            record.add(
+                bytes_read=instrumentation.path_bytes(*sorted_deconned_images),
+                bytes_written=_stored_bytes(root),
+            )
+    image_statistics = finalize_statistics(
+        image_statistics, window_percentiles
     )
+    window_start, window_end = image_statistics["percentiles"]
     # optional rendering settings
     root.attrs["omero"] = {
         "channels": [
             {
                 "color": "FFFFFF",
                 "window": {
-                    "start": int(min_value),
-                    "end": int(max_value),
+                    "start": int(window_start),
+                    "end": int(window_end),
                     "min": 0,
                     "max": 65535,
                 },
@@ -111,36 +469,58 @@ def process_images(stacks_root: str):
             }
         ]
     }
-    del total_array
+    del image_arrays
 
     # labels section
     # convert labels CSV into dict
-    atlas_images: Generator = atlas_subdir.rglob("*.tif")
-    sorted_atlas_images: list = sorted(list(atlas_images))
-    with tf.TiffFile(sorted_atlas_images[0]) as atlas_tif:
-        atlas_y_dim, atlas_x_dim = atlas_tif.pages[0].shape
-    print("Creating the Atlas dask array...")
-    atlas_array = da.zeros(
-        (len(sorted_atlas_images), atlas_y_dim, atlas_x_dim), dtype=da.uint16
+    atlas_stack = read_plane_stack(
+        sorted_atlas_images, dtype=np.uint16, roi=roi
     )
-    unique_atlas_values = set()
-    for i, atlas_image in tqdm(
-        enumerate(sorted_atlas_images), total=len(sorted_atlas_images)
-    ):
-        with tf.TiffFile(atlas_image) as atlas_tif:
-            atlas_tif_array = atlas_tif.asarray()
-            unique_values = set(np.unique(atlas_tif_array).astype(int))
-            unique_atlas_values.update(unique_values)
-            atlas_array[i, :, :] = atlas_tif_array
     labels_grp = root.create_group("labels")
     label_name = "atlas_regions"
     labels_grp.attrs["labels"] = [label_name]
     label_grp = labels_grp.create_group(label_name)
+    with instrumentation.stage(
+        "process_images.atlas", file=atlas_subdir
+    ) as record:
+        print("Creating the Atlas zarr arrays...")
+        atlas_arrays = create_pyramid(
+            label_grp,
+            atlas_stack.shape,
+            np.uint16,
+            max_layer=max_layer,
+            downscale=downscale,
+            **storage_options["atlas"],
+        )
+        # voxel count per label id, accumulated while the slabs are written
+        atlas_counts = np.zeros(LABEL_BINS, dtype=np.int64)
+        for z_start, atlas_slab in instrumentation.timed_iter(
+            _iter_slabs(atlas_stack, atlas_arrays[0].chunks[0]),
+            record,
+            "decode_s",
+        ):
+            atlas_counts += block_label_counts(atlas_slab)
+            with instrumentation.timer(record, "encode_s"):
+                write_slab(atlas_arrays[:1], atlas_slab, z_start)
+        print("Building the Atlas pyramid...")
+        with instrumentation.timer(record, "encode_s"):
+            build_pyramid(
+                atlas_arrays, atlas_kernel, downscale, max_workers
+            )
+        write_pyramid_metadata(
+            label_grp, atlas_arrays, "zyx", translation
+        )
+        if record is not None:
+            record.add(
+                bytes_read=instrumentation.path_bytes(*sorted_atlas_images),
+                bytes_written=_stored_bytes(label_grp),
+            )
+    atlas_label_ids = np.flatnonzero(atlas_counts)
     # create dictionary containing a list of dictionaries
     # that assigns rgba color for region id value
     atlas_df = pd.read_csv(atlas_color_map)
     mapped_colors = atlas_df["id"].unique()
-    missing_colors = list(unique_atlas_values - set(mapped_colors.astype(int)))
+    missing_colors = np.setdiff1d(atlas_label_ids, mapped_colors.astype(int))
     missing_colors = [int(x) for x in missing_colors if x > 0]
 
     colors_list = []
@@ -156,9 +536,17 @@ def process_images(stacks_root: str):
             "rgba": [0, 0, 0, 255],
         }
         colors_list.append(missing_color_dict)
-    atlas_labels_dict = {"colors": colors_list}
+    atlas_labels_dict = {
+        "colors": colors_list,
+        "properties": [
+            {
+                "label-value": int(label_id),
+                "voxel-count": int(atlas_counts[label_id]),
+            }
+            for label_id in atlas_label_ids
+        ],
+    }
     label_grp.attrs["image-label"] = atlas_labels_dict
-    write_image(atlas_array, label_grp, axes="zyx")
 
     # add-in the thresholds
     # color maps
@@ -175,29 +563,90 @@ def process_images(stacks_root: str):
         ).astype(int)
         return rgb_values
 
-    mask_generator = Path(
-        r"./data/210810_45670_ko_female_LH_14-48-50_decon_2021-10-28_12-39-11/640_FRST_seg"
-    ).glob("*.tif")
-    sorted_mask_files = sorted(list(mask_generator))
+    sorted_mask_files = _find_tiffs(segmentation_subdir, False, index)
     mask_color_values = get_rgb_from_cmap(
         "inferno", len(sorted_mask_files), starting_value=0.7, ending_value=1
     )
-    for mask_idx, mask_file in enumerate(sorted_mask_files):
-        threshold_value = int(mask_file.stem.split("_")[-1].lstrip("0"))
-        mask_name = f"FRSTseg {threshold_value}"
-        mask_grp = root.labels.create_group(mask_name)
-        with tf.TiffFile(mask_file) as mask_tif:
-            mask_y_dim, mask_x_dim = mask_tif.pages[0].shape
-            mask_z_dim = len(mask_tif.pages)
-            print("Making the mask dask array...")
-            mask_array = da.zeros(
-                (mask_z_dim, mask_y_dim, mask_x_dim), dtype=da.uint8
+    mask_slab_depth = storage_options["mask"]["chunks"][0]
+    if fold_masks:
+        # one volume whose value is the rank of the highest threshold passed
+        mask_thresholds = [
+            int(mask_file.stem.split("_")[-1].lstrip("0"))
+            for mask_file in sorted_mask_files
+        ]
+        if len(mask_thresholds) > 255:
+            raise ValueError(
+                f"{len(mask_thresholds)} thresholds do not fit a uint8 volume"
             )
-            print("...done!")
-            print("Propagating mask array...")
-            for i, page in tqdm(enumerate(mask_tif.pages), total=mask_z_dim):
-                mask_array[i, :, :] = page.asarray()
-            mask_colors = {
+        mask_order = np.argsort(mask_thresholds, kind="stable")
+        folded_files = [sorted_mask_files[i] for i in mask_order]
+        mask_shapes = {
+            probe_page_stack(mask_file, page_range=page_range, roi=roi)[0]
+            for mask_file in folded_files
+        }
+        if len(mask_shapes) != 1:
+            raise ValueError(f"Mask shapes differ: {sorted(mask_shapes)}")
+        folded_grp = labels_grp.create_group("FRSTseg")
+        folded_grp.attrs["image-label"] = {
+            "colors": [
+                {
+                    "label_value": rank,
+                    "rgba": mask_color_values[i].tolist() + [255],
+                }
+                for rank, i in enumerate(mask_order, start=1)
+            ],
+            "properties": [
+                {"label-value": rank, "threshold": mask_thresholds[i]}
+                for rank, i in enumerate(mask_order, start=1)
+            ],
+        }
+        labels_grp.attrs["labels"] += ["FRSTseg"]
+        print("Folding the mask arrays...")
+        with instrumentation.stage(
+            "process_images.mask",
+            file=segmentation_subdir,
+            output=folded_grp.path,
+        ) as record:
+            write_slabs(
+                _fold_mask_slabs(
+                    folded_files, mask_slab_depth, page_range, roi
+                ),
+                folded_grp,
+                mask_shapes.pop(),
+                np.uint8,
+                axes="zyx",
+                max_layer=max_layer,
+                downscale=downscale,
+                kernel=mask_kernel,
+                translation=translation,
+                max_workers=max_workers,
+                **storage_options["mask"],
+            )
+            if record is not None:
+                record.add(
+                    bytes_read=instrumentation.path_bytes(*sorted_mask_files),
+                    bytes_written=_stored_bytes(folded_grp),
+                )
+        # the per-threshold groups only describe how to recover their mask
+        for rank, i in enumerate(mask_order, start=1):
+            view_grp = labels_grp.create_group(
+                f"FRSTseg {mask_thresholds[i]}"
+            )
+            view_grp.attrs["folded-mask"] = {
+                "source": "../FRSTseg",
+                "threshold": mask_thresholds[i],
+                "min-label-value": rank,
+            }
+    else:
+        # groups and the labels list are set up here, in order, so the
+        # workers only write their own arrays
+        mask_jobs = []
+        mask_names = []
+        for mask_idx, mask_file in enumerate(sorted_mask_files):
+            threshold_value = int(mask_file.stem.split("_")[-1].lstrip("0"))
+            mask_name = f"FRSTseg {threshold_value}"
+            mask_grp = labels_grp.create_group(mask_name)
+            mask_grp.attrs["image-label"] = {
                 "colors": [
                     {
                         "label_value": 255,
@@ -205,40 +654,82 @@ def process_images(stacks_root: str):
                     }
                 ]
             }
-            mask_grp.attrs["image-label"] = mask_colors
-            root["labels"].attrs["labels"] += [mask_name]
-            write_image(mask_array, mask_grp, axes="zyx")
+            mask_names.append(mask_name)
+            mask_jobs.append((mask_file, mask_grp))
+        labels_grp.attrs["labels"] += mask_names
+        print("Propagating mask arrays...")
+        n_writers = max(1, min(len(mask_jobs), max_workers))
+        # the pyramid builds of the masks written together share the threads
+        level_workers = max(1, max_workers // n_writers)
+        with ThreadPoolExecutor(max_workers=n_writers) as pool:
+            futures = [
+                pool.submit(
+                    _write_mask,
+                    mask_file,
+                    mask_grp,
+                    mask_kernel,
+                    storage_options["mask"],
+                    max_layer,
+                    downscale,
+                    page_range,
+                    roi,
+                    translation,
+                    level_workers,
+                )
+                for mask_file, mask_grp in mask_jobs
+            ]
+            for future in futures:
+                future.result()
+        print("...done!")
 
     # heatmap section
     # due to contraints on OME-Zarr format, need to package separately
     heatmap_root = zarr.group(store=heatmap_store)
-    heatmap_images: Generator = heatmap_subdir.rglob("*.tif")
-    sorted_heatmap_images: list = sorted(list(heatmap_images))
-    with tf.TiffFile(sorted_heatmap_images[0]) as heatmap_tif:
-        heatmap_y_dim, heatmap_x_dim = heatmap_tif.pages[0].shape
-        heatmap_z_dim = len(heatmap_tif.pages)
-    print("Creating the dask array...")
-    heatmap_array = np.zeros(
-        (
-            len(sorted_heatmap_images),
-            heatmap_z_dim,
-            heatmap_y_dim,
-            heatmap_x_dim,
-        ),
-        dtype=np.float32,
-    )
-    print("...done!")
-    for thresh_idx, heatmap_image in enumerate(sorted_heatmap_images):
-        with tf.TiffFile(heatmap_image) as heatmap_tif:
-            heatmap_y_dim, heatmap_x_dim = heatmap_tif.pages[0].shape
-            heatmap_z_dim = len(heatmap_tif.pages)
-            for i, page in tqdm(
-                enumerate(heatmap_tif.pages), total=heatmap_z_dim
-            ):
-                heatmap_array[thresh_idx, i, :, :] = page.asarray()
-    scaler: np.float32 = np.float32(65535) / heatmap_array.max().item()
-    heatmap_scaled_array = np.round((heatmap_array * scaler)).astype(np.uint16)
-    write_image(image=heatmap_scaled_array, group=heatmap_root, axes="czyx")
+    sorted_heatmap_images: list = _find_tiffs(heatmap_subdir, True, index)
+    with instrumentation.stage(
+        "process_images.heatmap", file=heatmap_subdir
+    ) as record:
+        heatmap_stacks = [
+            read_page_stack(heatmap_image, dtype=np.float32)
+            for heatmap_image in sorted_heatmap_images
+        ]
+        # first pass: the global maximum sets the uint16 scaling
+        heatmap_max = compute_statistics(da.stack(heatmap_stacks))["max"]
+        scaler: np.float32 = np.float32(65535) / heatmap_max.item()
+        # second pass: scale and write every threshold concurrently
+        heatmap_arrays = create_pyramid(
+            heatmap_root,
+            (len(heatmap_stacks), *heatmap_stacks[0].shape),
+            np.uint16,
+            max_layer=max_layer,
+            downscale=downscale,
+            **storage_options["heatmap"],
+        )
+        print("Writing the heatmap stacks...")
+        n_writers = max(1, min(len(heatmap_stacks), max_workers))
+        with ThreadPoolExecutor(max_workers=n_writers) as executor:
+            # the channels add their decode and encode time to this stage
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    _write_heatmap_channel,
+                    heatmap_arrays,
+                    heatmap_image,
+                    channel,
+                    scaler,
+                    downscale,
+                )
+                for channel, heatmap_image in enumerate(sorted_heatmap_images)
+            ]
+            for future in futures:
+                future.result()
+        print("...done!")
+        write_pyramid_metadata(heatmap_root, heatmap_arrays, "czyx")
+        if record is not None:
+            record.add(
+                bytes_read=instrumentation.path_bytes(*sorted_heatmap_images),
+                bytes_written=_stored_bytes(heatmap_root),
+            )
 
 
 def main():
@@ -251,11 +742,148 @@ def main():
     parser.add_argument(
         "stacks_root",
         type=str,
-        required=True,
         help="The root directory containing the image stacks.",
     )
+    parser.add_argument(
+        "--window-percentiles",
+        type=float,
+        nargs=2,
+        default=(0.0, 100.0),
+        metavar=("LOW", "HIGH"),
+        help="Intensity percentiles used for the omero window "
+        "(default: 0 100, the minimum and maximum)",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        default=4,
+        help="Number of downsampled pyramid levels (default: 4)",
+    )
+    parser.add_argument(
+        "--downscale",
+        type=int,
+        default=2,
+        help="YX reduction factor between pyramid levels (default: 2)",
+    )
+    parser.add_argument(
+        "--image-kernel",
+        choices=KERNELS,
+        default="mean",
+        help="Downsampling kernel of the c-Fos image (default: mean)",
+    )
+    parser.add_argument(
+        "--atlas-kernel",
+        choices=KERNELS,
+        default="mode",
+        help="Downsampling kernel of the atlas regions (default: mode)",
+    )
+    parser.add_argument(
+        "--mask-kernel",
+        choices=KERNELS,
+        default="max",
+        help="Downsampling kernel of the FRSTseg masks (default: max)",
+    )
+    parser.add_argument(
+        "--storage-config",
+        type=str,
+        default=None,
+        help="JSON file mapping layers (image, atlas, mask, heatmap) to "
+        "make_storage_options arguments, e.g. "
+        '{"image": {"chunks": [32, 256, 256], "cname": "lz4"}}',
+    )
+    parser.add_argument(
+        "--fold-masks",
+        action="store_true",
+        help="Store the nested FRSTseg masks as one label volume holding "
+        "the highest threshold passed",
+    )
+    parser.add_argument(
+        "--z-range",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("START", "STOP"),
+        help="Only convert the planes with START <= Z index < STOP",
+    )
+    parser.add_argument(
+        "--roi",
+        type=int,
+        nargs=4,
+        default=None,
+        metavar=("Y0", "Y1", "X0", "X1"),
+        help="Only convert this crop of the image, atlas and mask planes",
+    )
+    parser.add_argument(
+        "--no-validate",
+        action="store_true",
+        help="Skip the header and Z index check of the image and atlas "
+        "planes",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Abort when the header and Z index check finds anomalies "
+        "instead of printing them",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="Threads building the pyramids and writing the masks and "
+        "heatmap channels (default: the number of CPUs)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=None,
+        help="SQLite inventory index the TIFF files are listed from, "
+        "created or refreshed as needed",
+    )
+    parser.add_argument(
+        "--instrument",
+        type=str,
+        default=None,
+        help="Append per-stage timing and memory records to this JSON "
+        "lines file",
+    )
     args = parser.parse_args()
-    process_images(args.stacks_root)
+    if args.instrument is not None:
+        instrumentation.enable(args.instrument)
+    storage_options = None
+    if args.storage_config is not None:
+        with open(args.storage_config) as f:
+            storage_config = json.load(f)
+        unknown_layers = set(storage_config) - set(STORAGE_LAYERS)
+        if unknown_layers:
+            raise ValueError(f"Unknown layers: {sorted(unknown_layers)}")
+        storage_options = {
+            layer: make_storage_options(**options)
+            for layer, options in storage_config.items()
+        }
+    index = None
+    if args.inventory is not None:
+        index = InventoryIndex(args.inventory)
+    try:
+        process_images(
+            args.stacks_root,
+            tuple(args.window_percentiles),
+            max_layer=args.levels,
+            downscale=args.downscale,
+            image_kernel=args.image_kernel,
+            atlas_kernel=args.atlas_kernel,
+            mask_kernel=args.mask_kernel,
+            storage_options=storage_options,
+            fold_masks=args.fold_masks,
+            index=index,
+            validate=not args.no_validate,
+            strict=args.strict,
+            z_range=args.z_range,
+            roi=args.roi,
+            max_workers=args.max_workers,
+        )
+    finally:
+        if index is not None:
+            index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+DEFAULT_CACHE_PATH: Path = Path.home().joinpath(
+    ".cache", "idisco-prep", "tiff_hashes.sqlite"
+)
+
+
+class HashCache:
+    """
+    On-disk cache of TIFF pixel and header hashes keyed by file identity.
+
+    An entry is only returned while the file's size, mtime_ns and inode are
+    unchanged, so a hit costs a single stat(). The least recently used
+    entries are evicted once the cache holds more than `max_entries`. The
+    cache can be shared by threads and is used as a context manager.
+
+    Parameters
+    ----------
+    cache_path : str or Path, optional
+        SQLite database file (default: DEFAULT_CACHE_PATH)
+    max_entries : int, optional
+        Number of entries kept after eviction (default: 1_000_000)
+    commit_every : int, optional
+        Number of changes batched per commit (default: 256)
+    """
+
+    def __init__(
+        self,
+        cache_path: Union[str, Path] = DEFAULT_CACHE_PATH,
+        max_entries: int = 1_000_000,
+        commit_every: int = 256,
+    ):
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.cache_path, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " path TEXT NOT NULL,"
+            " algorithm TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " inode INTEGER NOT NULL,"
+            " pixel_hash TEXT NOT NULL,"
+            " header_hash TEXT NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (path, algorithm))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _identity(path: Path) -> tuple[str, int, int, int]:
+        stat = os.stat(path)
+        return str(path.resolve()), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(
+        self, path: Union[str, Path], algorithm: str
+    ) -> Optional[tuple[str, str]]:
+        """
+        Return the cached (pixel_hash, header_hash) of an unchanged file.
+
+        Parameters
+        ----------
+        path : str or Path
+            TIFF file
+        algorithm : str
+            Digest the hashes were computed with
+        """
+        key, size, mtime_ns, inode = self._identity(Path(path))
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, inode, pixel_hash, header_hash"
+                " FROM hashes WHERE path = ? AND algorithm = ?",
+                (key, algorithm),
+            ).fetchone()
+            if row is None or row[:3] != (size, mtime_ns, inode):
+                return None
+            self._connection.execute(
+                "UPDATE hashes SET last_used = ?"
+                " WHERE path = ? AND algorithm = ?",
+                (time.time(), key, algorithm),
+            )
+            self._changed()
+        return row[3], row[4]
+
+    def put(
+        self,
+        path: Union[str, Path],
+        algorithm: str,
+        pixel_hash: str,
+        header_hash: str,
+    ) -> None:
+        """
+        Store the hashes of a file under its current identity.
+
+        Parameters
+        ----------
+        path : str or Path
+            TIFF file
+        algorithm : str
+            Digest the hashes were computed with
+        pixel_hash : str
+            Hash of the decoded pixel data
+        header_hash : str
+            Hash of the TIFF header
+        """
+        key, size, mtime_ns, inode = self._identity(Path(path))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    algorithm,
+                    size,
+                    mtime_ns,
+                    inode,
+                    pixel_hash,
+                    header_hash,
+                    time.time(),
+                ),
+            )
+            self._changed()
+
+    def _changed(self) -> None:
+        # callers hold the lock
+        self._changes += 1
+        if self._changes >= self.commit_every:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._connection.execute(
+            "DELETE FROM hashes WHERE rowid IN ("
+            " SELECT rowid FROM hashes ORDER BY last_used DESC"
+            " LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._connection.commit()
+        self._changes = 0
+
+    def close(self) -> None:
+        """Evict, commit and close the database."""
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+    def __enter__(self) -> "HashCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -1,38 +1,154 @@
+import argparse
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Any, Optional, Tuple, Union
 import pandas as pd
 
+import numpy as np
 import tifffile
 
+from hash_cache import HashCache
+from plane_sequence import PlaneSequence
 
-def calculate_tiff_hash(image_path: Union[str, Path]) -> str:
+# sha256 and blake2b come with hashlib, xxh3_128 and blake3 need the optional
+# xxhash and blake3 packages
+HASH_ALGORITHMS: tuple[str, ...] = ("sha256", "blake2b", "xxh3_128", "blake3")
+# tags that locate the image data in the file rather than describe it
+_LOCATION_TAGS: set[str] = {
+    "StripOffsets",
+    "StripByteCounts",
+    "TileOffsets",
+    "TileByteCounts",
+    "SubIFDs",
+}
+# columns of the frames returned for the directories, also when empty
+PAIR_COLUMNS: list[str] = ["filepath_1", "filepath_2"]
+COMPARISON_COLUMNS: list[str] = PAIR_COLUMNS + [
+    "same_hash",
+    "hash_1",
+    "hash_2",
+]
+TILE_COLUMNS: list[str] = PAIR_COLUMNS + [
+    "page",
+    "y_start",
+    "y_stop",
+    "x_start",
+    "x_stop",
+    "differing_voxels",
+]
+LABEL_COLUMNS: list[str] = PAIR_COLUMNS + [
+    "page",
+    "label",
+    "count_1",
+    "count_2",
+    "delta",
+]
+
+
+def _new_hasher(algorithm: str) -> Any:
+    """
+    Create an incremental hasher for one of HASH_ALGORITHMS.
+
+    Args:
+        algorithm: Name of the digest
+
+    Returns:
+        Object with update() and hexdigest() methods
+
+    Raises:
+        ValueError: If the algorithm is unknown or its package is missing
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(
+            f"Unknown hash algorithm {algorithm}, expected one of "
+            f"{HASH_ALGORITHMS}"
+        )
+    if algorithm == "xxh3_128":
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("xxh3_128 hashing requires the xxhash package")
+        return xxhash.xxh3_128()
+    if algorithm == "blake3":
+        try:
+            import blake3
+        except ImportError:
+            raise ValueError("blake3 hashing requires the blake3 package")
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+def _header_hash(tif: tifffile.TiffFile, algorithm: str) -> str:
+    """
+    Hash the descriptive header of an open TIFF.
+
+    Covers the page count, the series shape and dtype, and every tag of the
+    first page except the ones that only locate data in the file.
+
+    Args:
+        tif: Open TIFF file
+        algorithm: One of HASH_ALGORITHMS
+
+    Returns:
+        str: Hexadecimal string representation of the hash
+    """
+    hash_obj = _new_hasher(algorithm)
+    series = tif.series[0]
+    hash_obj.update(
+        repr((len(tif.pages), series.shape, str(series.dtype))).encode()
+    )
+    for tag in tif.pages[0].tags:
+        if tag.name not in _LOCATION_TAGS:
+            hash_obj.update(repr((tag.code, tag.value)).encode())
+    return hash_obj.hexdigest()
+
+
+def calculate_tiff_hashes(
+    image_path: Union[str, Path],
+    algorithm: str = "sha256",
+    cache: Optional[HashCache] = None,
+) -> Tuple[str, str]:
     """
-    Calculate SHA256 hash from TIFF image data.
+    Calculate the pixel data hash and the header hash of a TIFF image.
+
+    Pages are decoded one at a time and their buffers are fed to the hasher
+    without copying, so the pixel hash equals hashing
+    ``tif.asarray().tobytes()``. With a cache, an unchanged file is only
+    stat()ed.
 
     Args:
         image_path: Path to the TIFF image file
+        algorithm: One of HASH_ALGORITHMS (default: "sha256")
+        cache: Hash cache checked before decoding (default: None)
 
     Returns:
-        str: Hexadecimal string representation of the SHA256 hash
+        Tuple containing:
+            - Hash of the pixel data
+            - Hash of the header
 
     Raises:
         FileNotFoundError: If the image file doesn't exist
         ValueError: If there's an error reading the TIFF file
     """
+    hash_obj = _new_hasher(algorithm)
     try:
-        # Read the TIFF file
-        with tifffile.TiffFile(image_path) as tif:
-            image_data = tif.asarray()
+        if cache is not None:
+            cached = cache.get(image_path, algorithm)
+            if cached is not None:
+                return cached
 
-        # Convert image data to bytes
-        image_bytes = image_data.tobytes()
-
-        # Calculate SHA256 hash
-        hash_obj = hashlib.sha256()
-        hash_obj.update(image_bytes)
+        with tifffile.TiffFile(image_path) as tif:
+            header_hash = _header_hash(tif, algorithm)
+            for page in tif.series[0].pages:
+                page_data = np.ascontiguousarray(page.asarray(maxworkers=1))
+                hash_obj.update(memoryview(page_data).cast("B"))
+                del page_data
+        pixel_hash = hash_obj.hexdigest()
 
-        return hash_obj.hexdigest()
+        if cache is not None:
+            cache.put(image_path, algorithm, pixel_hash, header_hash)
+        return pixel_hash, header_hash
 
     except FileNotFoundError:
         raise FileNotFoundError(f"Image file not found: {image_path}")
@@ -40,8 +156,34 @@ def calculate_tiff_hash(image_path: Union[str, Path]) -> str:
         raise ValueError(f"Error reading TIFF file: {str(e)}")
 
 
+def calculate_tiff_hash(
+    image_path: Union[str, Path],
+    algorithm: str = "sha256",
+    cache: Optional[HashCache] = None,
+) -> str:
+    """
+    Calculate a hash from TIFF image data.
+
+    Args:
+        image_path: Path to the TIFF image file
+        algorithm: One of HASH_ALGORITHMS (default: "sha256")
+        cache: Hash cache checked before decoding (default: None)
+
+    Returns:
+        str: Hexadecimal string representation of the hash
+
+    Raises:
+        FileNotFoundError: If the image file doesn't exist
+        ValueError: If there's an error reading the TIFF file
+    """
+    return calculate_tiff_hashes(image_path, algorithm, cache)[0]
+
+
 def compare_tiff_images(
-    image1_path: Union[str, Path], image2_path: Union[str, Path]
+    image1_path: Union[str, Path],
+    image2_path: Union[str, Path],
+    algorithm: str = "sha256",
+    cache: Optional[HashCache] = None,
 ) -> Tuple[bool, str, str]:
     """
     Compare two TIFF images by calculating and comparing their hashes.
@@ -49,6 +191,8 @@ def compare_tiff_images(
     Args:
         image1_path: Path to the first TIFF image
         image2_path: Path to the second TIFF image
+        algorithm: One of HASH_ALGORITHMS (default: "sha256")
+        cache: Hash cache checked before decoding (default: None)
 
     Returns:
         Tuple containing:
@@ -60,33 +204,268 @@ def compare_tiff_images(
         FileNotFoundError: If either image file doesn't exist
         ValueError: If there's an error reading either TIFF file
     """
-    hash1 = calculate_tiff_hash(image1_path)
-    hash2 = calculate_tiff_hash(image2_path)
+    hash1 = calculate_tiff_hash(image1_path, algorithm, cache)
+    hash2 = calculate_tiff_hash(image2_path, algorithm, cache)
 
     return hash1 == hash2, hash1, hash2
 
 
+def compare_tiff_directories(
+    root1: Union[str, Path],
+    root2: Union[str, Path],
+    pattern: str = "Z*.tif",
+    algorithm: str = "sha256",
+    max_workers: int = 16,
+    cache: Optional[HashCache] = None,
+) -> pd.DataFrame:
+    """
+    Compare every plane in root1 with the plane of the same Z index in root2.
+
+    The planes may use different zero-padding, e.g. Z0990.tif and Z00990.tif.
+    Comparisons run concurrently on a thread pool.
+
+    Args:
+        root1: Directory of the first set of planes
+        root2: Directory of the second set of planes
+        pattern: Glob pattern matching the planes (default: "Z*.tif")
+        algorithm: One of HASH_ALGORITHMS (default: "sha256")
+        max_workers: Number of threads comparing planes (default: 16)
+        cache: Hash cache checked before decoding (default: None)
+
+    Returns:
+        pd.DataFrame: One row per plane with both paths and hashes
+
+    Raises:
+        FileNotFoundError: If a plane has no counterpart in root2
+    """
+    pairs = PlaneSequence.from_directory(root1, pattern).pair(
+        PlaneSequence.from_directory(root2, pattern)
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda pair: compare_tiff_images(*pair, algorithm, cache),
+            pairs,
+        )
+        image_results = [
+            {
+                "filepath_1": file,
+                "filepath_2": file_path2,
+                "same_hash": result,
+                "hash_1": hash1,
+                "hash_2": hash2,
+            }
+            for (file, file_path2), (result, hash1, hash2) in zip(
+                pairs, results
+            )
+        ]
+    return pd.DataFrame(image_results, columns=COMPARISON_COLUMNS)
+
+
+def _tile_digests(
+    plane: np.ndarray, tile_size: int, algorithm: str
+) -> list[list[str]]:
+    """
+    Hash a 2D plane in tile_size x tile_size tiles.
+
+    Args:
+        plane: 2D image
+        tile_size: Edge length of the tiles, edge tiles may be smaller
+        algorithm: One of HASH_ALGORITHMS
+
+    Returns:
+        list: Row-major grid of tile hex digests
+    """
+    digests = []
+    for y0 in range(0, plane.shape[0], tile_size):
+        row = []
+        for x0 in range(0, plane.shape[1], tile_size):
+            hash_obj = _new_hasher(algorithm)
+            tile = plane[y0 : y0 + tile_size, x0 : x0 + tile_size]
+            hash_obj.update(memoryview(np.ascontiguousarray(tile)).cast("B"))
+            row.append(hash_obj.hexdigest())
+        digests.append(row)
+    return digests
+
+
+def diff_tiff_images(
+    image1_path: Union[str, Path],
+    image2_path: Union[str, Path],
+    tile_size: int = 256,
+    algorithm: str = "blake2b",
+) -> Tuple[list[dict], list[dict]]:
+    """
+    Locate the differences between two TIFF images of the same shape.
+
+    Each page is hashed in fixed tiles and only differing tiles are
+    reported. For integer (label) images the per-label voxel counts of
+    every page pair are compared with np.bincount. Only one page of each
+    image is decoded at a time.
+
+    Args:
+        image1_path: Path to the first TIFF image
+        image2_path: Path to the second TIFF image
+        tile_size: Edge length of the compared tiles (default: 256)
+        algorithm: One of HASH_ALGORITHMS (default: "blake2b")
+
+    Returns:
+        Tuple containing:
+            - Differing tiles with page, y/x bounds and differing voxels
+            - Labels whose voxel count differs with both counts and the delta
+
+    Raises:
+        ValueError: If the images differ in page count, shape or dtype
+    """
+    tile_rows: list[dict] = []
+    label_rows: list[dict] = []
+    with tifffile.TiffFile(image1_path) as tif1, tifffile.TiffFile(
+        image2_path
+    ) as tif2:
+        pages1, pages2 = tif1.series[0].pages, tif2.series[0].pages
+        if len(pages1) != len(pages2):
+            raise ValueError(
+                f"{image1_path} has {len(pages1)} pages, "
+                f"{image2_path} has {len(pages2)}"
+            )
+        for page_idx, (page1, page2) in enumerate(zip(pages1, pages2)):
+            plane1, plane2 = page1.asarray(), page2.asarray()
+            if plane1.shape != plane2.shape or plane1.dtype != plane2.dtype:
+                raise ValueError(
+                    f"Page {page_idx} is {plane1.shape} {plane1.dtype} in "
+                    f"{image1_path} and {plane2.shape} {plane2.dtype} in "
+                    f"{image2_path}"
+                )
+            digests1 = _tile_digests(plane1, tile_size, algorithm)
+            digests2 = _tile_digests(plane2, tile_size, algorithm)
+            for tile_y, (row1, row2) in enumerate(zip(digests1, digests2)):
+                for tile_x, (digest1, digest2) in enumerate(zip(row1, row2)):
+                    if digest1 == digest2:
+                        continue
+                    y0, x0 = tile_y * tile_size, tile_x * tile_size
+                    y1 = min(y0 + tile_size, plane1.shape[0])
+                    x1 = min(x0 + tile_size, plane1.shape[1])
+                    tile_rows.append(
+                        {
+                            "page": page_idx,
+                            "y_start": y0,
+                            "y_stop": y1,
+                            "x_start": x0,
+                            "x_stop": x1,
+                            "differing_voxels": int(
+                                np.count_nonzero(
+                                    plane1[y0:y1, x0:x1]
+                                    != plane2[y0:y1, x0:x1]
+                                )
+                            ),
+                        }
+                    )
+            if not np.issubdtype(plane1.dtype, np.integer):
+                continue
+            counts1 = np.bincount(plane1.ravel())
+            counts2 = np.bincount(plane2.ravel())
+            n_labels = max(len(counts1), len(counts2))
+            counts1 = np.pad(counts1, (0, n_labels - len(counts1)))
+            counts2 = np.pad(counts2, (0, n_labels - len(counts2)))
+            for label in np.flatnonzero(counts1 != counts2):
+                label_rows.append(
+                    {
+                        "page": page_idx,
+                        "label": int(label),
+                        "count_1": int(counts1[label]),
+                        "count_2": int(counts2[label]),
+                        "delta": int(counts2[label]) - int(counts1[label]),
+                    }
+                )
+    return tile_rows, label_rows
+
+
+def diff_tiff_directories(
+    root1: Union[str, Path],
+    root2: Union[str, Path],
+    pattern: str = "Z*.tif",
+    tile_size: int = 256,
+    algorithm: str = "sha256",
+    max_workers: int = 16,
+    cache: Optional[HashCache] = None,
+    comparison_df: Optional[pd.DataFrame] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Report the differing tiles and label counts of mismatched plane pairs.
+
+    Planes are paired as in compare_tiff_directories and only pairs whose
+    pixel hashes differ are diffed, on a thread pool.
+
+    Args:
+        root1: Directory of the first set of planes
+        root2: Directory of the second set of planes
+        pattern: Glob pattern matching the planes (default: "Z*.tif")
+        tile_size: Edge length of the compared tiles (default: 256)
+        algorithm: One of HASH_ALGORITHMS, for the plane hashes
+            (default: "sha256")
+        max_workers: Number of threads comparing planes (default: 16)
+        cache: Hash cache checked before decoding (default: None)
+        comparison_df: Result of compare_tiff_directories for the same
+            directories, so the planes are not hashed again (default: None,
+            compared here)
+
+    Returns:
+        Tuple containing:
+            - Differing tiles, one row per tile with both paths
+            - Differing label counts, one row per label and plane pair
+    """
+    if comparison_df is None:
+        comparison_df = compare_tiff_directories(
+            root1, root2, pattern, algorithm, max_workers, cache
+        )
+    mismatched = comparison_df.loc[
+        ~comparison_df["same_hash"].astype(bool), PAIR_COLUMNS
+    ].itertuples(index=False)
+    pairs = list(mismatched)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        diffs = executor.map(
+            lambda pair: diff_tiff_images(*pair, tile_size=tile_size), pairs
+        )
+        tile_rows, label_rows = [], []
+        for (file, file_path2), (tiles, labels) in zip(pairs, diffs):
+            paths = {"filepath_1": file, "filepath_2": file_path2}
+            tile_rows.extend({**paths, **row} for row in tiles)
+            label_rows.extend({**paths, **row} for row in labels)
+    return (
+        pd.DataFrame(tile_rows, columns=TILE_COLUMNS),
+        pd.DataFrame(label_rows, columns=LABEL_COLUMNS),
+    )
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare two directories of TIFF planes and report the "
+        "differing tiles and label counts."
+    )
+    parser.add_argument(
+        "--algorithm",
+        choices=HASH_ALGORITHMS,
+        default="sha256",
+        help="Digest of the plane pixel hashes, the hash cache keeps one "
+        "entry per algorithm (default: sha256)",
+    )
+    args = parser.parse_args()
     root1 = Path(
         r"./data/210810_45670_ko_female_LH_14-48-50_decon_2021-10-28_12-39-11/atlaslabel_def_origspace"
     )
     root2 = Path(
         r"./data/210810_45670_ko_female_LH_14-48-50_decon_2021-10-28_12-39-11/atlaslabel_def_origspace_masked/"
     )
-    image_results = []
-    for file in root1.glob("Z*.tif"):
-        base_name = file.name.lstrip("Z").lstrip("0").removesuffix(".tif")
-        convert_name = "Z" + base_name.zfill(5) + ".tif"
-        file_path2 = root2.joinpath(convert_name)
-        assert file_path2.exists()
-        result, hash1, hash2 = compare_tiff_images(file, file_path2)
-        my_dict = {
-            "filepath_1": file,
-            "filepath_2": file_path2,
-            "same_hash": result,
-            "hash_1": hash1,
-            "hash_2": hash2,
-        }
-        image_results.append(my_dict)
-    df = pd.DataFrame(image_results)
+    with HashCache() as cache:
+        df = compare_tiff_directories(
+            root1, root2, algorithm=args.algorithm, cache=cache
+        )
+        tiles_df, labels_df = diff_tiff_directories(
+            root1,
+            root2,
+            algorithm=args.algorithm,
+            cache=cache,
+            comparison_df=df,
+        )
     df.to_csv("comparison_results.csv", index=False)
+    tiles_df.to_csv("tile_differences.csv", index=False)
+    labels_df.to_csv("label_differences.csv", index=False)
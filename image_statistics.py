@@ -0,0 +1,235 @@
+from typing import Optional, Sequence
+
+import dask
+import dask.array as da
+import numpy as np
+
+HISTOGRAM_BINS: int = 65536
+# atlas label ids fit in uint16
+LABEL_BINS: int = 65536
+
+
+def _tree_reduce(parts: list, merge) -> object:
+    """Merge delayed partial results pairwise and compute the final one."""
+    while len(parts) > 1:
+        merged = [
+            dask.delayed(merge)(first, second)
+            for first, second in zip(parts[::2], parts[1::2])
+        ]
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0].compute()
+
+
+def block_statistics(
+    block: np.ndarray,
+    bins: int = HISTOGRAM_BINS,
+    value_range: Optional[tuple[float, float]] = None,
+) -> dict:
+    """
+    Compute the min, max, voxel count and histogram of one block.
+
+    Integer blocks are histogrammed with np.bincount, one bin per value in
+    [0, bins). Other blocks only get a histogram when `value_range` is given.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Chunk or slab of the volume
+    bins : int, optional
+        Number of histogram bins (default: HISTOGRAM_BINS)
+    value_range : tuple[float, float], optional
+        Histogram range of non-integer data (default: None)
+    """
+    statistics = {
+        "min": block.min(),
+        "max": block.max(),
+        "count": block.size,
+        "histogram": None,
+    }
+    if np.issubdtype(block.dtype, np.integer):
+        if statistics["min"] < 0 or statistics["max"] >= bins:
+            raise ValueError(
+                f"Values in [{statistics['min']}, {statistics['max']}] "
+                f"do not fit {bins} histogram bins"
+            )
+        statistics["histogram"] = np.bincount(block.ravel(), minlength=bins)
+    elif value_range is not None:
+        statistics["histogram"] = np.histogram(
+            block, bins=bins, range=value_range
+        )[0]
+    return statistics
+
+
+def merge_statistics(first: Optional[dict], second: dict) -> dict:
+    """
+    Merge two results of block_statistics, `first` may be None.
+
+    Parameters
+    ----------
+    first : dict, optional
+        Statistics accumulated so far
+    second : dict
+        Statistics of another block
+    """
+    if first is None:
+        return second
+    histogram = None
+    if first["histogram"] is not None and second["histogram"] is not None:
+        histogram = first["histogram"] + second["histogram"]
+    return {
+        "min": min(first["min"], second["min"]),
+        "max": max(first["max"], second["max"]),
+        "count": first["count"] + second["count"],
+        "histogram": histogram,
+    }
+
+
+def histogram_percentiles(
+    histogram: np.ndarray,
+    percentiles: Sequence[float],
+    bin_edges: Optional[np.ndarray] = None,
+) -> list[float]:
+    """
+    Look up percentiles in a histogram.
+
+    The p-th percentile is the lowest bin reached by ceil(p% of the voxels),
+    so 0 and 100 give the lowest and highest occupied bins.
+
+    Parameters
+    ----------
+    histogram : np.ndarray
+        Voxel counts per bin
+    percentiles : Sequence[float]
+        Percentiles in [0, 100]
+    bin_edges : np.ndarray, optional
+        Bin edges, the left edge is returned; by default bin i has value i
+    """
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    values = []
+    for percentile in percentiles:
+        rank = min(max(int(np.ceil(percentile / 100 * total)), 1), total)
+        index = int(np.searchsorted(cumulative, rank))
+        values.append(index if bin_edges is None else float(bin_edges[index]))
+    return values
+
+
+def compute_statistics(
+    stack: da.Array,
+    percentiles: Sequence[float] = (0.1, 99.9),
+    bins: int = HISTOGRAM_BINS,
+    value_range: Optional[tuple[float, float]] = None,
+) -> dict:
+    """
+    Compute global statistics of a lazy volume in one parallel pass.
+
+    Every chunk is reduced to its min, max and histogram on the dask
+    scheduler, and the partial results are merged pairwise in a tree.
+
+    Parameters
+    ----------
+    stack : da.Array
+        Lazy volume, e.g. from tiff_readers.read_plane_stack
+    percentiles : Sequence[float], optional
+        Percentiles to report when a histogram is available
+        (default: (0.1, 99.9))
+    bins : int, optional
+        Number of histogram bins (default: HISTOGRAM_BINS)
+    value_range : tuple[float, float], optional
+        Histogram range of non-integer data (default: None)
+
+    Returns
+    -------
+    dict
+        "min", "max", "count", "histogram" and "percentiles", the last two
+        being None without a histogram
+    """
+    if np.issubdtype(stack.dtype, np.integer):
+        value_range = None
+    parts = [
+        dask.delayed(block_statistics)(block, bins, value_range)
+        for block in stack.to_delayed().ravel()
+    ]
+    statistics = _tree_reduce(parts, merge_statistics)
+    return finalize_statistics(statistics, percentiles, bins, value_range)
+
+
+def finalize_statistics(
+    statistics: dict,
+    percentiles: Sequence[float] = (0.1, 99.9),
+    bins: int = HISTOGRAM_BINS,
+    value_range: Optional[tuple[float, float]] = None,
+) -> dict:
+    """
+    Add the percentiles to merged block statistics.
+
+    Parameters
+    ----------
+    statistics : dict
+        Result of block_statistics / merge_statistics
+    percentiles : Sequence[float], optional
+        Percentiles to report when a histogram is available
+        (default: (0.1, 99.9))
+    bins : int, optional
+        Number of histogram bins (default: HISTOGRAM_BINS)
+    value_range : tuple[float, float], optional
+        Histogram range the statistics of non-integer data were computed
+        with (default: None)
+    """
+    statistics = dict(statistics)
+    statistics["percentiles"] = None
+    if statistics["histogram"] is not None:
+        bin_edges = None
+        if value_range is not None:
+            bin_edges = np.linspace(*value_range, bins + 1)
+        statistics["percentiles"] = histogram_percentiles(
+            statistics["histogram"], percentiles, bin_edges
+        )
+    return statistics
+
+
+def block_label_counts(
+    block: np.ndarray, n_labels: int = LABEL_BINS
+) -> np.ndarray:
+    """
+    Count the voxels of every label id in one block of a label volume.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Chunk or slab of non-negative integer labels
+    n_labels : int, optional
+        Length of the count array, label ids must be below it
+        (default: LABEL_BINS)
+    """
+    counts = np.bincount(block.ravel(), minlength=n_labels)
+    if len(counts) > n_labels:
+        raise ValueError(f"Label ids exceed the {n_labels} counted labels")
+    return counts
+
+
+def label_census(stack: da.Array, n_labels: int = LABEL_BINS) -> np.ndarray:
+    """
+    Count the voxels of every label id of a lazy label volume in parallel.
+
+    Parameters
+    ----------
+    stack : da.Array
+        Lazy label volume, e.g. the atlas planes from read_plane_stack
+    n_labels : int, optional
+        Length of the count array, label ids must be below it
+        (default: LABEL_BINS)
+
+    Returns
+    -------
+    np.ndarray
+        Voxel count indexed by label id, present labels are
+        ``np.flatnonzero(counts)``
+    """
+    parts = [
+        dask.delayed(block_label_counts)(block, n_labels)
+        for block in stack.to_delayed().ravel()
+    ]
+    return _tree_reduce(parts, np.add)
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+import pandas as pd
+import psutil
+
+# JSON lines file the stage records are appended to; inherited by workers
+INSTRUMENT_ENV: str = "IDISCO_PREP_INSTRUMENT"
+
+_current: ContextVar[Optional["StageRecord"]] = ContextVar(
+    "instrumentation_stage", default=None
+)
+_write_lock = threading.Lock()
+
+
+class PeakRSS:
+    """
+    Track the peak resident set size of this process while a block runs.
+
+    RSS is sampled on a background thread every `interval` seconds. The RSS
+    on entry is kept as `baseline_bytes`, so `growth_bytes` is the memory
+    the block added on top of what the process already held.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Sampling interval in seconds (default: 0.02)
+    """
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak_bytes = 0
+        self.baseline_bytes = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while True:
+            rss = self._process.memory_info().rss
+            self.peak_bytes = max(self.peak_bytes, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    @property
+    def growth_bytes(self) -> int:
+        """Peak RSS above the RSS on entry."""
+        return max(0, self.peak_bytes - self.baseline_bytes)
+
+    def __enter__(self) -> "PeakRSS":
+        self.baseline_bytes = self._process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+class StageRecord:
+    """
+    Measurements of one stage, written as a JSON line when the stage ends.
+
+    Parameters
+    ----------
+    name : str
+        Stage name, e.g. "aggregate_tiffs_to_ome"
+    fields : dict
+        Extra fields of the record, e.g. {"file": ...}
+    """
+
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = dict(fields)
+        self.values: dict[str, float] = {
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "decode_s": 0.0,
+            "encode_s": 0.0,
+        }
+        self._lock = threading.Lock()
+
+    def add(self, **values: float) -> None:
+        """Add to counters such as bytes_read, bytes_written or decode_s."""
+        with self._lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, field: str) -> Iterator[None]:
+        """Add the time spent in the block to `field`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(**{field: time.perf_counter() - start})
+
+
+def log_path() -> Optional[Path]:
+    """Return the JSON lines file records go to, None when disabled."""
+    path = os.environ.get(INSTRUMENT_ENV)
+    return Path(path) if path else None
+
+
+def enable(path: Union[str, Path]) -> None:
+    """
+    Record stages of this process and of workers it starts to `path`.
+
+    Parameters
+    ----------
+    path : str or Path
+        JSON lines file the records are appended to
+    """
+    os.environ[INSTRUMENT_ENV] = str(Path(path).resolve())
+
+
+def disable() -> None:
+    """Stop recording stages."""
+    os.environ.pop(INSTRUMENT_ENV, None)
+
+
+def current() -> Optional[StageRecord]:
+    """Return the innermost running stage of this context, if any."""
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[Optional[StageRecord]]:
+    """
+    Measure a stage: wall time, peak RSS and the counters added to it.
+
+    Yields None when instrumentation is disabled, so callers guard any
+    extra measurement work with ``if record is not None``.
+
+    Parameters
+    ----------
+    name : str
+        Stage name
+    **fields
+        Extra JSON-serialisable fields, e.g. file=input_path
+    """
+    path = log_path()
+    if path is None:
+        yield None
+        return
+    record = StageRecord(name, fields)
+    token = _current.set(record)
+    status = "error"
+    started = datetime.now(timezone.utc).isoformat()
+    start = time.perf_counter()
+    try:
+        with PeakRSS() as memory:
+            yield record
+        status = "ok"
+    finally:
+        wall = time.perf_counter() - start
+        _current.reset(token)
+        line = {
+            "stage": name,
+            **{key: str(value) for key, value in record.fields.items()},
+            "status": status,
+            "started": started,
+            "wall_s": wall,
+            **record.values,
+            "peak_rss_bytes": memory.peak_bytes,
+            "pid": os.getpid(),
+        }
+        with _write_lock, open(path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+
+
+def timer(record: Optional[StageRecord], field: str):
+    """Return ``record.timer(field)``, or a no-op when `record` is None."""
+    return nullcontext() if record is None else record.timer(field)
+
+
+def timed_iter(
+    iterable: Iterable, record: Optional[StageRecord], field: str
+) -> Iterable:
+    """
+    Add the time spent producing each item of `iterable` to `field`.
+
+    Returns `iterable` unchanged when `record` is None.
+
+    Parameters
+    ----------
+    iterable : Iterable
+        Items, e.g. planes decoded on demand
+    record : StageRecord, optional
+        Stage the time is added to
+    field : str
+        Counter name, e.g. "decode_s"
+    """
+    if record is None:
+        return iterable
+
+    def timed() -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                record.add(**{field: time.perf_counter() - start})
+            yield item
+
+    return timed()
+
+
+@contextmanager
+def timed_write(items: Iterable) -> Iterator[Iterable]:
+    """
+    Split the time of a write streaming `items` between decode and encode.
+
+    Within the current stage, the time spent producing the yielded items is
+    added to decode_s and the rest of the block to encode_s, so a writer
+    consuming planes decoded on demand reports reading and writing
+    separately. Yields `items` unchanged outside a stage.
+
+    Parameters
+    ----------
+    items : Iterable
+        Items the block consumes, e.g. planes decoded on demand
+    """
+    record = current()
+    if record is None:
+        yield items
+        return
+    decode_start = record.values["decode_s"]
+    start = time.perf_counter()
+    yield timed_iter(items, record, "decode_s")
+    decode = record.values["decode_s"] - decode_start
+    record.add(encode_s=time.perf_counter() - start - decode)
+
+
+def path_bytes(*paths: Union[str, Path]) -> int:
+    """Return the size in bytes of files, directories counted recursively."""
+    total = 0
+    for path in map(Path, paths):
+        if path.is_dir():
+            total += sum(
+                f.stat().st_size for f in path.rglob("*") if f.is_file()
+            )
+        elif path.exists():
+            total += path.stat().st_size
+    return total
+
+
+def summarize(path: Union[str, Path]) -> pd.DataFrame:
+    """
+    Summarise a JSON lines log per stage.
+
+    Parameters
+    ----------
+    path : str or Path
+        Log written by stage
+
+    Returns
+    -------
+    pd.DataFrame
+        Count, total wall/decode/encode time, total bytes, read and write
+        MB/s and the highest peak RSS of every stage
+    """
+    records = pd.read_json(path, lines=True)
+    summary = records.groupby("stage").agg(
+        count=("wall_s", "size"),
+        errors=("status", lambda status: int((status != "ok").sum())),
+        wall_s=("wall_s", "sum"),
+        decode_s=("decode_s", "sum"),
+        encode_s=("encode_s", "sum"),
+        bytes_read=("bytes_read", "sum"),
+        bytes_written=("bytes_written", "sum"),
+        peak_rss_MB=("peak_rss_bytes", "max"),
+    )
+    summary["peak_rss_MB"] /= 2**20
+    summary["read_MBps"] = summary["bytes_read"] / 2**20 / summary["wall_s"]
+    summary["write_MBps"] = (
+        summary["bytes_written"] / 2**20 / summary["wall_s"]
+    )
+    return summary.reset_index()
+
+
+def main():
+    """
+    Print, and optionally save as CSV, the per-stage summary of a log.
+    """
+    parser = argparse.ArgumentParser(
+        description="Summarise an instrumentation JSON lines log per stage."
+    )
+    parser.add_argument("log", type=str, help="JSON lines log")
+    parser.add_argument(
+        "--csv", type=str, default=None, help="Optional summary CSV"
+    )
+    args = parser.parse_args()
+    summary = summarize(args.log)
+    print(summary.to_string(index=False, float_format="%.2f"))
+    if args.csv is not None:
+        summary.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+import argparse
+import fnmatch
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import tifffile
+
+DEFAULT_INVENTORY_PATH: Path = Path.home().joinpath(
+    ".cache", "idisco-prep", "inventory.sqlite"
+)
+# entries with these suffixes are planes or stacks, never directories
+TIFF_SUFFIXES: tuple[str, ...] = (".tif", ".tiff")
+
+
+@dataclass(frozen=True)
+class InventoryEntry:
+    """
+    One entry of an indexed directory.
+
+    Parameters
+    ----------
+    path : Path
+        Entry path, joined to the directory as the caller gave it
+    is_dir : bool
+        Whether the entry is a directory, following symlinks
+    is_symlink : bool
+        Whether the entry is a symlink
+    size : int, optional
+        Size in bytes of a file, None for directories and broken links
+    mtime_ns : int, optional
+        Modification time of a file, None for directories and broken links
+    """
+
+    path: Path
+    is_dir: bool
+    is_symlink: bool
+    size: Optional[int] = None
+    mtime_ns: Optional[int] = None
+
+
+def _scan(directory: Path) -> list[tuple]:
+    """List a directory as entries rows, one stat per file."""
+    rows = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            is_symlink = entry.is_symlink()
+            is_dir = False
+            # TIFF entries are taken as files without a type lookup
+            if not entry.name.lower().endswith(TIFF_SUFFIXES):
+                is_dir = entry.is_dir()
+            size = mtime_ns = None
+            if not is_dir:
+                try:
+                    stat = entry.stat()
+                    size, mtime_ns = stat.st_size, stat.st_mtime_ns
+                except FileNotFoundError:
+                    # broken symlink
+                    pass
+            rows.append((entry.name, is_dir, is_symlink, size, mtime_ns))
+    return rows
+
+
+def probe_tiff(path: Union[str, Path]) -> dict:
+    """
+    Read the header facts of a TIFF file without decoding pixels.
+
+    Parameters
+    ----------
+    path : str or Path
+        TIFF file
+
+    Returns
+    -------
+    dict
+        "shape", "dtype" and "bitspersample" of the first page, the number
+        of "pages" and the "compression" name
+    """
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        return {
+            "shape": list(page.shape),
+            "dtype": str(page.dtype),
+            "bitspersample": page.bitspersample,
+            "pages": len(tif.pages),
+            "compression": page.compression.name,
+        }
+
+
+class InventoryIndex:
+    """
+    On-disk index of directory listings and TIFF header facts.
+
+    A listing is served from the index while its directory's mtime_ns is
+    unchanged, so listing an unchanged directory costs a single stat()
+    however many planes it holds; changed directories are rescanned on
+    access. Header facts are kept while the file's size and mtime_ns in
+    its listing are unchanged. Files rewritten in place without touching
+    their directory are only seen once their directory is rescanned. The
+    index can be shared by threads and is used as a context manager.
+
+    Parameters
+    ----------
+    index_path : str or Path, optional
+        SQLite database file (default: DEFAULT_INVENTORY_PATH)
+    """
+
+    def __init__(self, index_path: Union[str, Path] = DEFAULT_INVENTORY_PATH):
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.index_path, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " scanned REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " path TEXT PRIMARY KEY,"
+            " directory TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " is_dir INTEGER NOT NULL,"
+            " is_symlink INTEGER NOT NULL,"
+            " size INTEGER,"
+            " mtime_ns INTEGER)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_directory"
+            " ON entries (directory)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tiffs ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " shape TEXT NOT NULL,"
+            " dtype TEXT NOT NULL,"
+            " bitspersample INTEGER NOT NULL,"
+            " pages INTEGER NOT NULL,"
+            " compression TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(path: Union[str, Path]) -> str:
+        # no resolve(), which would stat every component
+        return os.path.abspath(path)
+
+    def listdir(self, directory: Union[str, Path]) -> list[InventoryEntry]:
+        """
+        Return the entries of a directory in scandir order.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Directory to list
+        """
+        directory = Path(directory)
+        key = self._key(directory)
+        mtime_ns = os.stat(directory).st_mtime_ns
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT mtime_ns FROM directories WHERE path = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] == mtime_ns:
+                rows = self._connection.execute(
+                    "SELECT name, is_dir, is_symlink, size, mtime_ns"
+                    " FROM entries WHERE directory = ? ORDER BY rowid",
+                    (key,),
+                ).fetchall()
+            else:
+                rows = None
+        if rows is None:
+            rows = _scan(directory)
+            with self._lock:
+                self._connection.execute(
+                    "DELETE FROM entries WHERE directory = ?", (key,)
+                )
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES"
+                    " (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (os.path.join(key, name), key, name, *facts)
+                        for name, *facts in rows
+                    ],
+                )
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                    (key, mtime_ns, time.time()),
+                )
+                self._connection.commit()
+        return [
+            InventoryEntry(
+                directory.joinpath(name),
+                bool(is_dir),
+                bool(is_symlink),
+                size,
+                file_mtime_ns,
+            )
+            for name, is_dir, is_symlink, size, file_mtime_ns in rows
+        ]
+
+    def entry(self, path: Union[str, Path]) -> Optional[InventoryEntry]:
+        """Return the entry of `path` from its parent's listing, if any."""
+        path = Path(path)
+        try:
+            listing = self.listdir(path.parent)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        for entry in listing:
+            if entry.path.name == path.name:
+                return entry
+        return None
+
+    def exists(self, path: Union[str, Path]) -> bool:
+        """Return whether `path` exists, as Path.exists would."""
+        entry = self.entry(path)
+        return entry is not None and (
+            entry.is_dir or entry.size is not None
+        )
+
+    def is_dir(self, path: Union[str, Path]) -> bool:
+        """Return whether `path` is a directory, as Path.is_dir would."""
+        entry = self.entry(path)
+        return entry is not None and entry.is_dir
+
+    def walk(self, directory: Union[str, Path]) -> list[InventoryEntry]:
+        """
+        Return every entry below a directory, depth first as rglob walks.
+
+        Symlinked directories are listed but not descended into.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Root of the walk
+        """
+        entries: list[InventoryEntry] = []
+        stack: list[Path] = [Path(directory)]
+        while stack:
+            listing = self.listdir(stack.pop())
+            entries.extend(listing)
+            stack.extend(
+                entry.path
+                for entry in reversed(listing)
+                if entry.is_dir and not entry.is_symlink
+            )
+        return entries
+
+    def glob(
+        self,
+        directory: Union[str, Path],
+        pattern: str,
+        recursive: bool = False,
+    ) -> list[Path]:
+        """
+        Return the entries of a directory whose name matches `pattern`.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Directory to search
+        pattern : str
+            Shell pattern of the names, e.g. "*.tif"
+        recursive : bool, optional
+            Search the whole tree, as rglob does (default: False)
+        """
+        if recursive:
+            entries = self.walk(directory)
+        else:
+            entries = self.listdir(directory)
+        return [
+            entry.path
+            for entry in entries
+            if fnmatch.fnmatchcase(entry.path.name, pattern)
+        ]
+
+    def tiff_info(self, path: Union[str, Path]) -> dict:
+        """
+        Return the header facts of a TIFF file, see probe_tiff.
+
+        Parameters
+        ----------
+        path : str or Path
+            TIFF file
+        """
+        return self.tiff_infos([path])[0]
+
+    def tiff_infos(
+        self, paths: Sequence[Union[str, Path]], max_workers: int = 16
+    ) -> list[dict]:
+        """
+        Return the header facts of TIFF files, see probe_tiff.
+
+        Each parent directory is listed once and only the headers of new
+        or changed files are probed, on a thread pool.
+
+        Parameters
+        ----------
+        paths : Sequence[str or Path]
+            TIFF files
+        max_workers : int, optional
+            Number of headers probed concurrently (default: 16)
+        """
+        return self._tiff_infos(paths, max_workers)[0]
+
+    def _tiff_infos(
+        self, paths: Sequence[Union[str, Path]], max_workers: int
+    ) -> tuple[list[dict], int]:
+        paths = [Path(path) for path in paths]
+        entries: dict[str, InventoryEntry] = {}
+        for parent in dict.fromkeys(path.parent for path in paths):
+            for entry in self.listdir(parent):
+                entries[self._key(entry.path)] = entry
+        keys = [self._key(path) for path in paths]
+        for path, key in zip(paths, keys):
+            if key not in entries or entries[key].size is None:
+                raise FileNotFoundError(f"{path} does not exist")
+        infos: dict[str, dict] = {}
+        with self._lock:
+            # bounded by SQLite's limit on host parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                for row in self._connection.execute(
+                    "SELECT path, size, mtime_ns, shape, dtype,"
+                    " bitspersample, pages, compression FROM tiffs"
+                    f" WHERE path IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ):
+                    entry = entries[row[0]]
+                    if row[1:3] == (entry.size, entry.mtime_ns):
+                        infos[row[0]] = {
+                            "shape": json.loads(row[3]),
+                            "dtype": row[4],
+                            "bitspersample": row[5],
+                            "pages": row[6],
+                            "compression": row[7],
+                        }
+        stale = list(dict.fromkeys(key for key in keys if key not in infos))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probed = list(
+                executor.map(lambda key: probe_tiff(entries[key].path), stale)
+            )
+        self._put_tiffs(
+            [(key, entries[key], info) for key, info in zip(stale, probed)]
+        )
+        infos.update(zip(stale, probed))
+        return [infos[key] for key in keys], len(stale)
+
+    def _put_tiffs(
+        self, probed: list[tuple[str, InventoryEntry, dict]]
+    ) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO tiffs VALUES"
+                " (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        key,
+                        entry.size,
+                        entry.mtime_ns,
+                        json.dumps(info["shape"]),
+                        info["dtype"],
+                        info["bitspersample"],
+                        info["pages"],
+                        info["compression"],
+                    )
+                    for key, entry, info in probed
+                ],
+            )
+            self._connection.commit()
+
+    def refresh(
+        self,
+        directory: Union[str, Path],
+        probe_headers: bool = True,
+        max_workers: int = 16,
+    ) -> int:
+        """
+        Bring the index of a tree up to date.
+
+        Changed directories are rescanned and, optionally, the headers of
+        new or changed TIFF files are probed on a thread pool.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Root of the tree
+        probe_headers : bool, optional
+            Probe the TIFF headers too (default: True)
+        max_workers : int, optional
+            Number of headers probed concurrently (default: 16)
+
+        Returns
+        -------
+        int
+            Number of TIFF headers probed
+        """
+        entries = self.walk(directory)
+        if not probe_headers:
+            return 0
+        tiffs = [
+            entry.path
+            for entry in entries
+            if entry.size is not None
+            and entry.path.name.lower().endswith(TIFF_SUFFIXES)
+        ]
+        return self._tiff_infos(tiffs, max_workers)[1]
+
+    def close(self) -> None:
+        """Commit and close the database."""
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __enter__(self) -> "InventoryIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def main():
+    """
+    Index raw iDISCO trees, probing the headers of new or changed TIFFs.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build or refresh the dataset inventory index."
+    )
+    parser.add_argument("roots", type=str, nargs="+", help="Trees to index")
+    parser.add_argument(
+        "--index",
+        type=str,
+        default=str(DEFAULT_INVENTORY_PATH),
+        help="SQLite index file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-headers",
+        action="store_true",
+        help="Only index the directory listings",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="Number of headers probed concurrently (default: 16)",
+    )
+    args = parser.parse_args()
+    with InventoryIndex(args.index) as index:
+        for root in args.roots:
+            start = time.perf_counter()
+            probed = index.refresh(
+                root,
+                probe_headers=not args.no_headers,
+                max_workers=args.workers,
+            )
+            print(
+                f"{root}: {probed} headers probed in "
+                f"{time.perf_counter() - start:.1f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
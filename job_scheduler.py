@@ -0,0 +1,162 @@
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+import tifffile
+
+from manifest import append_record, atomic_output, is_up_to_date
+from manifest import load_manifest, make_record, options_digest
+
+
+@dataclass
+class PackagingTask:
+    """
+    One independent packaging output.
+
+    Runs as `function(source, output, *args, **kwargs)`, where `output` is a
+    temporary path renamed into place once the function returns.
+
+    Attributes
+    ----------
+    function : Callable
+        Module level function producing the output, so it can be pickled
+    source : Path
+        Input TIFF file or directory of planes
+    output : Path
+        Path of the file the task writes
+    args : tuple
+        Further positional arguments of `function`
+    memory_bytes : int
+        Estimated peak memory of the task, used for admission
+    kwargs : dict
+        Keyword arguments of `function`
+    """
+
+    function: Callable
+    source: Path
+    output: Path
+    args: tuple = ()
+    memory_bytes: int = 0
+    kwargs: dict = field(default_factory=dict)
+
+    @property
+    def options(self) -> str:
+        """Digest of the options the output is written with."""
+        return options_digest(self.function, self.args, self.kwargs)
+
+
+def _run_task(task: PackagingTask) -> dict:
+    """Write the output of `task` atomically and return its manifest record."""
+    with atomic_output(task.output) as partial:
+        task.function(task.source, partial, *task.args, **task.kwargs)
+    return make_record(task.source, task.output, task.options)
+
+
+def physical_memory_bytes() -> int:
+    """Return the physical memory of this node in bytes."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def page_bytes(tif_path: Path) -> int:
+    """
+    Return the decoded size of the first page of a TIFF, reading only its header.
+
+    Parameters
+    ----------
+    tif_path : Path
+        TIFF file to probe
+    """
+    with tifffile.TiffFile(tif_path) as tif:
+        return tif.pages[0].nbytes
+
+
+def run_tasks(
+    tasks: list[PackagingTask],
+    max_jobs: int = 1,
+    max_memory_bytes: Optional[int] = None,
+    manifest_path: Optional[Path] = None,
+    force_overwrite: bool = False,
+    verify: bool = False,
+) -> None:
+    """
+    Run packaging tasks on a process pool.
+
+    A task is admitted once fewer than `max_jobs` tasks are running and its
+    estimated memory fits next to the running ones under `max_memory_bytes`.
+    A task larger than the limit still runs, but only on its own. Failures
+    are reported once every other task has finished.
+
+    With a manifest, tasks whose output was finished from unchanged inputs
+    and options are skipped, and a record is appended for every task that
+    completes.
+
+    Parameters
+    ----------
+    tasks : list[PackagingTask]
+        Tasks to run, admitted in order
+    max_jobs : int, optional
+        Maximum number of concurrently running tasks (default: 1)
+    max_memory_bytes : int, optional
+        Memory budget shared by the running tasks, defaults to 80% of the
+        physical memory of the node
+    manifest_path : Path, optional
+        JSON lines manifest of finished outputs (default: None)
+    force_overwrite : bool, optional
+        Run every task regardless of the manifest (default: False)
+    verify : bool, optional
+        Recompute output checksums before skipping a task (default: False)
+    """
+    if max_memory_bytes is None:
+        max_memory_bytes = int(0.8 * physical_memory_bytes())
+    pending: list[PackagingTask] = list(tasks)
+    if manifest_path is not None and not force_overwrite:
+        records = load_manifest(manifest_path)
+        pending = []
+        for task in tasks:
+            record = records.get(str(task.output))
+            if record is not None and is_up_to_date(
+                record, task.source, task.output, verify, task.options
+            ):
+                print(f"Skipping {task.output} because it is up to date")
+            else:
+                pending.append(task)
+    running: dict[Future, PackagingTask] = {}
+    failures: list[tuple[PackagingTask, BaseException]] = []
+    print(f"Running {len(pending)} packaging tasks on {max_jobs} workers")
+    with ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        while pending or running:
+            running_memory = sum(task.memory_bytes for task in running.values())
+            while pending and len(running) < max_jobs:
+                task = pending[0]
+                if (
+                    running
+                    and running_memory + task.memory_bytes > max_memory_bytes
+                ):
+                    break
+                pending.pop(0)
+                future = executor.submit(_run_task, task)
+                running[future] = task
+                running_memory += task.memory_bytes
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                exception = future.exception()
+                if exception is not None:
+                    print(f"Failed to write {task.output}: {exception}")
+                    failures.append((task, exception))
+                else:
+                    print(f"Finished {task.output}")
+                    if manifest_path is not None:
+                        append_record(manifest_path, future.result())
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} packaging tasks failed: "
+            + ", ".join(str(task.output) for task, _ in failures)
+        )
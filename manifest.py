@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+# options that change how an output is written but not what is written
+EXECUTION_OPTIONS: tuple[str, ...] = (
+    "max_workers",
+    "max_memory_mb",
+    "dry_run",
+)
+
+
+def input_fingerprint(source: Path, pattern: str = "*.tif") -> list[list]:
+    """
+    Return [name, size, mtime_ns] for every input file of a packaging output.
+
+    Parameters
+    ----------
+    source : Path
+        Input TIFF file, or directory of single-plane TIFF files
+    pattern : str, optional
+        Glob pattern matching the planes of a directory (default: "*.tif")
+    """
+    source = Path(source)
+    if source.is_dir():
+        files = sorted(source.glob(pattern))
+    else:
+        files = [source]
+    fingerprint = []
+    for file in files:
+        stat = file.stat()
+        fingerprint.append([file.name, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def options_digest(
+    function: Callable, args: tuple = (), kwargs: Optional[dict] = None
+) -> str:
+    """
+    Return the SHA256 hex digest of the options an output is written with.
+
+    Keyword arguments in EXECUTION_OPTIONS are left out, so rerunning with
+    more workers does not invalidate finished outputs.
+
+    Parameters
+    ----------
+    function : Callable
+        Function writing the output
+    args : tuple, optional
+        Positional arguments after the source and output (default: ())
+    kwargs : dict, optional
+        Keyword arguments (default: None)
+    """
+    options = {
+        "function": f"{function.__module__}.{function.__qualname__}",
+        "args": list(args),
+        "kwargs": {
+            name: value
+            for name, value in (kwargs or {}).items()
+            if name not in EXECUTION_OPTIONS
+        },
+    }
+    encoded = json.dumps(options, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def file_checksum(path: Path) -> str:
+    """Return the SHA256 hex digest of a file, read in blocks."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+@contextmanager
+def atomic_output(output: Path) -> Iterator[Path]:
+    """
+    Yield a temporary path that is renamed to `output` once the block succeeds.
+
+    A crash or exception leaves `output` untouched and removes the partial
+    file, so an existing `output` is always a finished write.
+
+    Parameters
+    ----------
+    output : Path
+        Final path of the file
+    """
+    output = Path(output)
+    partial = output.with_name(f".{output.name}.partial")
+    try:
+        yield partial
+        os.replace(partial, output)
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+def load_manifest(manifest_path: Path) -> dict[str, dict]:
+    """
+    Read a JSON lines manifest, the last record of every output wins.
+
+    Parameters
+    ----------
+    manifest_path : Path
+        Manifest file, which may not exist yet
+    """
+    records: dict[str, dict] = {}
+    if not Path(manifest_path).exists():
+        return records
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by a crash while appending
+                continue
+            records[record["output"]] = record
+    return records
+
+
+def append_record(manifest_path: Path, record: dict) -> None:
+    """
+    Append a record to a JSON lines manifest and flush it to disk.
+
+    Parameters
+    ----------
+    manifest_path : Path
+        Manifest file
+    record : dict
+        Record from make_record
+    """
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def make_record(
+    source: Path, output: Path, options: Optional[str] = None
+) -> dict:
+    """
+    Describe a finished output and the inputs it was written from.
+
+    Parameters
+    ----------
+    source : Path
+        Input TIFF file or directory of planes
+    output : Path
+        Finished output file
+    options : str, optional
+        options_digest of the options the output was written with
+    """
+    return {
+        "output": str(output),
+        "source": str(source),
+        "inputs": input_fingerprint(source),
+        "options": options,
+        "output_size": Path(output).stat().st_size,
+        "output_sha256": file_checksum(output),
+        "completed": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def is_up_to_date(
+    record: dict,
+    source: Path,
+    output: Path,
+    verify: bool = False,
+    options: Optional[str] = None,
+) -> bool:
+    """
+    Check whether `output` was finished from the current state of `source`.
+
+    An output written with other options, e.g. another compression or tile
+    shape, or recorded without them, is not up to date.
+
+    Parameters
+    ----------
+    record : dict
+        Manifest record of `output`
+    source : Path
+        Input TIFF file or directory of planes
+    output : Path
+        Output file
+    verify : bool, optional
+        Also recompute the output checksum (default: False)
+    options : str, optional
+        options_digest of the options the output would be written with
+    """
+    output = Path(output)
+    if not output.exists():
+        return False
+    if output.stat().st_size != record["output_size"]:
+        return False
+    if record["source"] != str(source):
+        return False
+    if record.get("options") != options:
+        return False
+    if record["inputs"] != input_fingerprint(source):
+        return False
+    if verify and file_checksum(output) != record["output_sha256"]:
+        return False
+    return True
@@ -0,0 +1,178 @@
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import tifffile
+
+import instrumentation
+from zarr_writer import downsample_slab
+
+# tifffile compression of every supported codec name
+COMPRESSIONS: dict[str, str] = {
+    "deflate": "ADOBE_DEFLATE",
+    "zstd": "ZSTD",
+    "lzw": "LZW",
+    "lzma": "LZMA",
+    "none": "NONE",
+}
+# codecs tifffile can only encode with the optional imagecodecs package
+_IMAGECODECS_COMPRESSIONS: tuple[str, ...] = ("zstd", "lzw")
+
+
+def compression_options(
+    compression: str = "deflate", level: Optional[int] = None
+) -> dict:
+    """
+    Return the tifffile write arguments of a compression codec.
+
+    Parameters
+    ----------
+    compression : str, optional
+        One of COMPRESSIONS (default: "deflate")
+    level : int, optional
+        Codec compression level, ignored by "lzw" and "none" (default: the
+        codec's default level)
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"Unknown compression {compression!r}, expected one of "
+            f"{tuple(COMPRESSIONS)}"
+        )
+    if compression in _IMAGECODECS_COMPRESSIONS:
+        try:
+            import imagecodecs  # noqa: F401
+        except ImportError as e:
+            raise ValueError(
+                f"{compression} compression requires the imagecodecs package"
+            ) from e
+    options = {"compression": COMPRESSIONS[compression]}
+    if level is not None and compression not in ("lzw", "none"):
+        options["compressionargs"] = {"level": level}
+    return options
+
+
+def _iter_chunks(
+    planes: Iterable[np.ndarray], tile: Optional[tuple[int, int]]
+) -> Iterator[np.ndarray]:
+    """Yield whole planes, or their tiles in row-major order when tiled."""
+    for plane in planes:
+        if tile is None:
+            yield plane
+            continue
+        for y in range(0, plane.shape[0], tile[0]):
+            for x in range(0, plane.shape[1], tile[1]):
+                # tifffile pads the edge tiles
+                yield plane[y : y + tile[0], x : x + tile[1]]
+
+
+def write_ome_tiff(
+    output_path,
+    planes: Iterable[np.ndarray],
+    shape: tuple,
+    dtype: np.dtype,
+    metadata: dict,
+    tile: Optional[tuple[int, int]] = None,
+    levels: int = 0,
+    downscale: int = 2,
+    kernel: str = "mean",
+    compression: str = "deflate",
+    compression_level: Optional[int] = None,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Stream ZYX planes into a BigTIFF OME-TIFF, optionally tiled and with a
+    pyramid of SubIFD levels.
+
+    Each plane is downsampled as soon as it is read and its levels are
+    spilled to temporary files next to the output, so the planes are
+    iterated once and memory stays proportional to one plane. Its time is
+    split as described in instrumentation.timed_write.
+
+    Parameters
+    ----------
+    output_path : str or Path
+        Path of the OME-TIFF
+    planes : Iterable[np.ndarray]
+        YX planes in Z order
+    shape : tuple
+        ZYX shape of the stack
+    dtype : np.dtype
+        Data type of the planes
+    metadata : dict
+        OME metadata passed to tifffile
+    tile : tuple[int, int], optional
+        YX tile shape, multiples of 16, e.g. (512, 512) (default: None,
+        strips)
+    levels : int, optional
+        Number of downsampled SubIFD levels (default: 0)
+    downscale : int, optional
+        YX reduction factor between levels (default: 2)
+    kernel : str, optional
+        Downsampling kernel, one of zarr_writer.KERNELS (default: "mean")
+    compression : str, optional
+        One of COMPRESSIONS (default: "deflate")
+    compression_level : int, optional
+        Codec compression level (default: the codec's default level)
+    max_workers : int, optional
+        Number of threads compressing the strips or tiles of a page
+        (default: tifffile's default)
+    """
+    options = {
+        "dtype": dtype,
+        "photometric": "minisblack",
+        "maxworkers": max_workers,
+        **compression_options(compression, compression_level),
+    }
+    if tile is not None:
+        tile = tuple(tile)
+        options["tile"] = tile
+    level_shapes = []
+    level_shape = tuple(shape)
+    for _ in range(levels):
+        level_shape = (
+            level_shape[0],
+            level_shape[1] // downscale,
+            level_shape[2] // downscale,
+        )
+        level_shapes.append(level_shape)
+
+    with instrumentation.timed_write(
+        planes
+    ) as planes, tempfile.TemporaryDirectory(
+        dir=Path(output_path).parent
+    ) as tmp, tifffile.TiffWriter(output_path, bigtiff=True, ome=True) as tif:
+        level_planes = [
+            np.lib.format.open_memmap(
+                Path(tmp, f"level_{level}.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=level_shape,
+            )
+            for level, level_shape in enumerate(level_shapes, start=1)
+        ]
+
+        def spill_levels() -> Iterator[np.ndarray]:
+            for z, plane in enumerate(planes):
+                reduced = plane
+                for stored in level_planes:
+                    reduced = downsample_slab(reduced, downscale, kernel)
+                    stored[z] = reduced
+                yield plane
+
+        tif.write(
+            _iter_chunks(spill_levels(), tile),
+            shape=shape,
+            subifds=levels or None,
+            metadata=metadata,
+            **options,
+        )
+        for stored in level_planes:
+            tif.write(
+                _iter_chunks(stored, tile),
+                shape=stored.shape,
+                subfiletype=1,
+                **options,
+            )
+        # release the memmaps before their directory is removed
+        level_planes.clear()
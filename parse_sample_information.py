@@ -1,12 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from aggregate_ome_tiffs import aggregate_tiffs_to_ome
 from add_ome_to_tiffs import add_ome_metadata
+from job_scheduler import PackagingTask, page_bytes, run_tasks
+import instrumentation
+from inventory import InventoryIndex
 from tqdm import tqdm
 import json
+import os
 import re
 from shutil import copy2
 import pandas as pd
-from typing import Generator
+from typing import Generator, Optional
 KO_DIR: Path = Path("./final/KO")
 FLOXED_DIR: Path = Path("./final/FLOX")
 DERVIATIVE_SUBDIRS: list[str] = [
@@ -16,45 +21,156 @@ DERVIATIVE_SUBDIRS: list[str] = [
     "640_FRST_seg",
     "heatmaps_atlasspace",
 ]
+# siblings of a derivative subdirectory packaged along with it
+SUBDIR_VARIANTS: list[str] = ["_corrected", "_corr", "_masked", "_hemisphere"]
+# entries with these suffixes are planes, never descended into
+PLANE_SUFFIXES: tuple[str, ...] = (".tif", ".tiff")
+DISCOVERY_WORKERS: int = 16
 ROOT_DIR: Path = Path("./final/bakalar_catnip")
+AGGREGATION_WORKERS: int = 16
+AGGREGATION_MAX_MEMORY_MB: float = 256
+# each aggregation already compresses on AGGREGATION_WORKERS threads
+MAX_JOBS: int = max(1, (os.cpu_count() or 1) // 4)
 
 
-def parse_directories(path: Path) -> pd.DataFrame:
+def _list_entries(
+    directory: str, index: Optional[InventoryIndex] = None
+) -> list[tuple[str, str, bool, bool, bool]]:
+    """
+    List (name, path, is_dir, is_link, exists) of a directory's non-planes.
+    """
+    try:
+        if index is not None:
+            return [
+                (
+                    entry.path.name,
+                    str(entry.path),
+                    entry.is_dir,
+                    entry.is_symlink,
+                    entry.is_dir or entry.size is not None,
+                )
+                for entry in index.listdir(directory)
+                if not entry.path.name.lower().endswith(PLANE_SUFFIXES)
+            ]
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except PermissionError:
+        return []
+    rows = []
+    for entry in entries:
+        if entry.name.lower().endswith(PLANE_SUFFIXES):
+            continue
+        is_dir = entry.is_dir()
+        is_link = entry.is_symlink()
+        exists = is_dir or not is_link or os.path.exists(entry.path)
+        rows.append((entry.name, entry.path, is_dir, is_link, exists))
+    return rows
+
+
+def _scan_sample(
+    dir_path: Path, index: Optional[InventoryIndex] = None
+) -> tuple[dict[str, list[Path]], set[Path]]:
+    """
+    Walk a sample tree once, collecting the derivative subdirectories.
+
+    Directories are visited depth first in scandir order, as rglob does,
+    without following symlinks. Plane files are recognised by their suffix
+    so the thousands of entries of a plane directory cost no stat calls.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Sample directory
+    index : InventoryIndex, optional
+        Inventory the listings are read from instead of the filesystem
+
+    Returns
+    -------
+    tuple[dict[str, list[Path]], set[Path]]
+        Directories named after each of DERVIATIVE_SUBDIRS in walk order,
+        and the existing entries named after one of their SUBDIR_VARIANTS
+    """
+    variant_names = {
+        name + variant
+        for name in DERVIATIVE_SUBDIRS
+        for variant in SUBDIR_VARIANTS
+    }
+    matches: dict[str, list[Path]] = {name: [] for name in DERVIATIVE_SUBDIRS}
+    variants: set[Path] = set()
+    stack: list[str] = [str(dir_path)]
+    while stack:
+        subdirs: list[str] = []
+        for name, path, is_dir, is_link, exists in _list_entries(
+            stack.pop(), index
+        ):
+            if name in matches and is_dir:
+                matches[name].append(Path(path))
+            elif name in variant_names and exists:
+                variants.add(Path(path))
+            if is_dir and not is_link:
+                subdirs.append(path)
+        # reversed so the first subdirectory is walked first
+        stack.extend(reversed(subdirs))
+    return matches, variants
+
+
+def parse_directories(
+    path: Path,
+    max_workers: int = DISCOVERY_WORKERS,
+    index: Optional[InventoryIndex] = None,
+) -> pd.DataFrame:
+    """
+    Collect the sample information of the sample directories under `path`.
+
+    Each sample tree is walked once by _scan_sample, the trees are walked
+    concurrently.
+
+    Parameters
+    ----------
+    path : Path
+        Directory holding one directory per sample, e.g. KO_DIR
+    max_workers : int, optional
+        Number of sample trees walked concurrently (default:
+        DISCOVERY_WORKERS)
+    index : InventoryIndex, optional
+        Inventory the listings are read from instead of the filesystem
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per sample with all its derivative subdirectories in "paths"
+    """
     dir_dicts: list[dict] = []
 
-    for dir_path in path.iterdir():
-        if not dir_path.is_dir():
-            continue
+    if index is None:
+        dir_paths: list[Path] = [
+            dir_path for dir_path in path.iterdir() if dir_path.is_dir()
+        ]
+    else:
+        dir_paths = [
+            entry.path for entry in index.listdir(path) if entry.is_dir
+        ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scans = list(
+            executor.map(lambda d: _scan_sample(d, index), dir_paths)
+        )
+
+    for dir_path, (matches, variants) in zip(dir_paths, scans):
         found_subdirs = True
         all_subdirs: list[Path] = []
         for subdir_name in DERVIATIVE_SUBDIRS:
-            found_this_subdir = False
-            for subdir in dir_path.rglob(subdir_name):
-                if subdir.is_dir():
-                    found_this_subdir = True
-                    all_subdirs.append(subdir)
-                    subdir_corrected = subdir.parent.joinpath(
-                        subdir.name + "_corrected"
-                    )
-                    subdir_corr = subdir.parent.joinpath(subdir.name + "_corr")
-                    subdir_masked = subdir.parent.joinpath(
-                        subdir.name + "_masked"
+            if matches[subdir_name]:
+                # the first match, as the first hit of rglob was used
+                subdir = matches[subdir_name][0]
+                all_subdirs.append(subdir)
+                for variant in SUBDIR_VARIANTS:
+                    extended_subdir = subdir.parent.joinpath(
+                        subdir.name + variant
                     )
-                    subdir_hemisphere = subdir.parent.joinpath(
-                        subdir.name + "_hemisphere"
-                    )
-                    extended_subdir_list = [
-                        subdir_corrected,
-                        subdir_corr,
-                        subdir_masked,
-                        subdir_hemisphere,
-                    ]
-                    for extended_subdir in extended_subdir_list:
-                        if extended_subdir.exists():
-                            print(f"Found {extended_subdir} in {dir_path}")
-                            all_subdirs.append(extended_subdir)
-                    break
-            if not found_this_subdir:
+                    if extended_subdir in variants:
+                        print(f"Found {extended_subdir} in {dir_path}")
+                        all_subdirs.append(extended_subdir)
+            else:
                 print(
                     f"Warning: Directory {dir_path} does not contain '{subdir_name}' subdirectory anywhere in its tree"
                 )
@@ -99,9 +215,11 @@ def parse_directories(path: Path) -> pd.DataFrame:
     return df
 
 
-def combine_sample_info() -> pd.DataFrame:
-    ko_df: pd.DataFrame = parse_directories(KO_DIR)
-    floxed_df: pd.DataFrame = parse_directories(FLOXED_DIR)
+def combine_sample_info(
+    index: Optional[InventoryIndex] = None,
+) -> pd.DataFrame:
+    ko_df: pd.DataFrame = parse_directories(KO_DIR, index=index)
+    floxed_df: pd.DataFrame = parse_directories(FLOXED_DIR, index=index)
     return pd.concat([ko_df, floxed_df], axis=0, ignore_index=True)
 
 
@@ -128,7 +246,83 @@ def process_paths(df: pd.DataFrame) -> pd.DataFrame:
     return result_df
 
 
-def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_overwrite: bool = False) -> None:
+def _aggregation_task(
+    input_dir: Path, output: Path, dry_run: bool
+) -> PackagingTask:
+    first_plane: Optional[Path] = next(Path(input_dir).glob("*.tif"), None)
+    if first_plane is None:
+        raise ValueError(f"No *.tif planes to aggregate in {input_dir}")
+    plane_bytes: int = page_bytes(first_plane)
+    # prefetched planes plus the plane being compressed and its strips
+    memory_bytes: int = int(AGGREGATION_MAX_MEMORY_MB * 2**20) + 2 * plane_bytes
+    return PackagingTask(
+        function=aggregate_tiffs_to_ome,
+        source=input_dir,
+        output=output,
+        kwargs={
+            "max_workers": AGGREGATION_WORKERS,
+            "dry_run": dry_run,
+            "max_memory_mb": AGGREGATION_MAX_MEMORY_MB,
+        },
+        memory_bytes=memory_bytes,
+    )
+
+
+def _metadata_task(input_path: Path, output: Path, dry_run: bool) -> PackagingTask:
+    # pages are decoded, re-encoded and written one at a time
+    memory_bytes: int = 4 * page_bytes(input_path)
+    return PackagingTask(
+        function=add_ome_metadata,
+        source=input_path,
+        output=output,
+        args=("original",),
+        kwargs={"dry_run": dry_run},
+        memory_bytes=memory_bytes,
+    )
+
+
+def create_bids(
+    root_dir: Path,
+    df: pd.DataFrame,
+    dry_run: bool = False,
+    force_overwrite: bool = False,
+    max_jobs: int = 1,
+    max_memory_bytes: Optional[int] = None,
+    manifest_path: Optional[Path] = None,
+    instrument_path: Optional[Path] = None,
+) -> None:
+    """
+    Package the samples in `df` as a BIDS dataset under `root_dir`.
+
+    The sidecar JSON files and directories are written up front, every
+    OME-TIFF output is then an independent task run by job_scheduler.
+    Outputs recorded in the manifest as finished from unchanged inputs are
+    not rewritten.
+
+    Parameters
+    ----------
+    root_dir : Path
+        Root of the BIDS dataset
+    df : pd.DataFrame
+        Sample information from process_paths
+    dry_run : bool, optional
+        Write small placeholder images instead of reading the inputs
+    force_overwrite : bool, optional
+        Rewrite outputs even if the manifest records them as up to date
+    max_jobs : int, optional
+        Maximum number of outputs written concurrently (default: 1)
+    max_memory_bytes : int, optional
+        Memory budget shared by the concurrent outputs, defaults to 80% of
+        the physical memory of the node
+    manifest_path : Path, optional
+        JSON lines manifest of finished outputs, defaults to
+        `<root_dir>_manifest.jsonl` next to the dataset so it is not uploaded,
+        and not used for dry runs
+    instrument_path : Path, optional
+        JSON lines file that the create_bids stage and the per-file
+        aggregate_tiffs_to_ome and add_ome_metadata stages of the workers
+        are appended to, summarised with instrumentation.py
+    """
     root_dir.mkdir(parents=True, exist_ok=True)
     derivatives_dir: Path = root_dir.joinpath("derivatives")
     derivatives_dir.mkdir(parents=True, exist_ok=True)
@@ -167,6 +361,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
     #         "sample_type",
     #     ]
     # )
+    tasks: list[PackagingTask] = []
     for _, row in df.iterrows():
         if row["640_N4"] is not None:
             subject_dir: Path = root_dir.joinpath(row["participant_id"])
@@ -174,10 +369,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             micro_dir: Path = subject_dir.joinpath("micr")
             micro_dir.mkdir(parents=True, exist_ok=True)
             filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_SPIM.ome.btf")
-            if not filepath_bft.exists() or force_overwrite:
-                aggregate_tiffs_to_ome(row["640_N4"], filepath_bft, max_workers=16, dry_run=dry_run)
-            else:
-                print(f"Skipping {filepath_bft} because it already exists")
+            tasks.append(_aggregation_task(row["640_N4"], filepath_bft, dry_run))
         if row["640_FRST"] is not None:
             frst_dir: Path = derivatives_dir.joinpath("FastRadialSymmetryTransform")
             frst_dir.mkdir(parents=True, exist_ok=True)
@@ -193,10 +385,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             micro_dir: Path = subject_dir.joinpath("micr")
             micro_dir.mkdir(parents=True, exist_ok=True)
             filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_SPIM.ome.btf")
-            if not filepath_bft.exists() or force_overwrite:
-                aggregate_tiffs_to_ome(row["640_FRST"], filepath_bft, max_workers=16, dry_run=dry_run)
-            else:
-                print(f"Skipping {filepath_bft} because it already exists")
+            tasks.append(_aggregation_task(row["640_FRST"], filepath_bft, dry_run))
         if row["640_FRST_hemisphere"] is not None:
             frst_hemisphere_dir: Path = derivatives_dir.joinpath("FastRadialSymmetryTransformHemisphere")
             frst_hemisphere_dir.mkdir(parents=True, exist_ok=True)
@@ -213,10 +402,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             micro_dir: Path = subject_dir.joinpath("micr")
             micro_dir.mkdir(parents=True, exist_ok=True)
             filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_SPIM.ome.btf")
-            if not filepath_bft.exists() or force_overwrite:
-                aggregate_tiffs_to_ome(row["640_FRST_hemisphere"], filepath_bft, max_workers=16, dry_run=dry_run)
-            else:
-                print(f"Skipping {filepath_bft} because it already exists")
+            tasks.append(_aggregation_task(row["640_FRST_hemisphere"], filepath_bft, dry_run))
         if row["atlaslabel_def_origspace"] is not None:
             atlaslabel_dir: Path = derivatives_dir.joinpath("AtlasLabel")
             atlaslabel_dir.mkdir(parents=True, exist_ok=True)
@@ -237,10 +423,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             micro_dir: Path = subject_dir.joinpath("micr")
             micro_dir.mkdir(parents=True, exist_ok=True)
             filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_space-orig_dseg.ome.btf")
-            if not filepath_bft.exists() or force_overwrite:
-                aggregate_tiffs_to_ome(row["atlaslabel_def_origspace"], filepath_bft, max_workers=16, dry_run=dry_run)
-            else:
-                print(f"Skipping {filepath_bft} because it already exists")
+            tasks.append(_aggregation_task(row["atlaslabel_def_origspace"], filepath_bft, dry_run))
         if row["atlaslabel_def_origspace_masked"] is not None:
             atlaslabel_masked_dir: Path = derivatives_dir.joinpath("AtlasLabelMasked")
             atlaslabel_masked_dir.mkdir(parents=True, exist_ok=True)
@@ -262,10 +445,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             micro_dir: Path = subject_dir.joinpath("micr")
             micro_dir.mkdir(parents=True, exist_ok=True)
             filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_space-orig_dseg.ome.btf")
-            if not filepath_bft.exists() or force_overwrite:
-                aggregate_tiffs_to_ome(row["atlaslabel_def_origspace_masked"], filepath_bft, max_workers=16, dry_run=dry_run)
-            else:
-                print(f"Skipping {filepath_bft} because it already exists")
+            tasks.append(_aggregation_task(row["atlaslabel_def_origspace_masked"], filepath_bft, dry_run))
         if row["640_FRST_seg"] is not None:
             frst_seg_dir: Path = derivatives_dir.joinpath("FastRadialSymmetryTransformSegmentation")
             frst_seg_dir.mkdir(parents=True, exist_ok=True)
@@ -286,10 +466,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
             for tif in frst_seg_tifs:
                 acq_string: str = tif.stem.split("_")[-1]
                 filepath_bft: Path = micro_dir.joinpath(f"{row['participant_id']}_{row['sample_id']}_acq-{acq_string}_SPIM.ome.btf")
-                if not filepath_bft.exists() or force_overwrite:
-                    add_ome_metadata(tif, filepath_bft, "original", dry_run=dry_run)
-                else:
-                    print(f"Skipping {filepath_bft} because it already exists")
+                tasks.append(_metadata_task(tif, filepath_bft, dry_run))
         if row["heatmaps_atlasspace"] is not None:
             heatmaps_dir: Path = derivatives_dir.joinpath("HeatmapsAtlasSpace")
             heatmaps_dir.mkdir(parents=True, exist_ok=True)
@@ -308,10 +485,7 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
                 filepath_bft: Path = micro_dir.joinpath(
                     f"{row['participant_id']}_{row['sample_id']}_acq-{acq_string}_res-25um_SPIM.ome.btf"
                 )
-                if not filepath_bft.exists() or force_overwrite:
-                    add_ome_metadata(tif, filepath_bft, "original", dry_run=dry_run)
-                else:
-                    print(f"Skipping {filepath_bft} because it already exists")
+                tasks.append(_metadata_task(tif, filepath_bft, dry_run))
         if row["heatmaps_atlasspace_corrected"] is not None:
             heatmaps_corrected_dir: Path = derivatives_dir.joinpath("HeatmapsAtlasSpaceCorrected")
             heatmaps_corrected_dir.mkdir(parents=True, exist_ok=True)
@@ -330,16 +504,37 @@ def create_bids(root_dir: Path, df: pd.DataFrame, dry_run: bool = False, force_o
                 filepath_bft: Path = micro_dir.joinpath(
                     f"{row['participant_id']}_{row['sample_id']}_acq-{acq_string}_res-25um_SPIM.ome.btf"
                 )
-                if not filepath_bft.exists() or force_overwrite:
-                    add_ome_metadata(tif, filepath_bft, "original", dry_run=dry_run)
-                else:
-                    print(f"Skipping {filepath_bft} because it already exists")
-
+                tasks.append(_metadata_task(tif, filepath_bft, dry_run))
+    if dry_run:
+        # placeholder outputs must not be recorded as finished
+        manifest_path = None
+    elif manifest_path is None:
+        manifest_path = root_dir.with_name(root_dir.name + "_manifest.jsonl")
+    if instrument_path is not None:
+        # workers inherit the setting through the environment
+        instrumentation.enable(instrument_path)
+    with instrumentation.stage(
+        "create_bids", file=root_dir, tasks=len(tasks)
+    ) as record:
+        run_tasks(
+            tasks,
+            max_jobs=max_jobs,
+            max_memory_bytes=max_memory_bytes,
+            manifest_path=manifest_path,
+            force_overwrite=force_overwrite,
+        )
+        if record is not None and not dry_run:
+            record.add(
+                bytes_written=instrumentation.path_bytes(
+                    *(task.output for task in tasks)
+                )
+            )
 
 
 if __name__ == "__main__":
     ROOT_DIR.mkdir(parents=True, exist_ok=True)
-    df = combine_sample_info()
+    with InventoryIndex() as index:
+        df = combine_sample_info(index)
     df = process_paths(df)
     participants_df = df[
         ["participant_id", "species", "strain"]
@@ -350,7 +545,7 @@ if __name__ == "__main__":
     df.to_csv("all_sample_information.tsv", sep="\t", index=False)
     participants_df.to_csv(ROOT_DIR.joinpath("participants.tsv"), sep="\t", index=False)
     sample_df.to_csv(ROOT_DIR.joinpath("samples.tsv"), sep="\t", index=False)
-    create_bids(ROOT_DIR, df, dry_run=False, force_overwrite=True)
+    create_bids(ROOT_DIR, df, dry_run=False, force_overwrite=False, max_jobs=MAX_JOBS)
     copy2("./LICENSE", ROOT_DIR.joinpath("LICENSE"))
     copy2("./data_README.md", ROOT_DIR.joinpath("README.md"))
     copy2("./dataset_description.json", ROOT_DIR.joinpath("dataset_description.json"))
@@ -1,6 +1,8 @@
 import os
 from pathlib import Path
 
+from inventory import InventoryIndex
+
 FLOXED_STRAIN: str = "C57BL/6N"
 KO_STRAIN: str = "C57BL6/N"
 SPECIES: str = "mus musculus"
@@ -8,7 +10,15 @@ SUBJECTS_DIR: Path = Path("data/bids/derivatives")
 TSV_FILEPATH: Path = Path("data/bids/derivatives/participants.tsv")
 
 
-def list_subjects(root_dir: str | Path) -> list[str]:
+def list_subjects(
+    root_dir: str | Path, index: InventoryIndex | None = None
+) -> list[str]:
+    if index is not None:
+        return [
+            entry.path.name
+            for entry in index.listdir(root_dir)
+            if entry.is_dir
+        ]
     subdirs = []
     for entry in os.listdir(root_dir):
         entry_path = os.path.join(root_dir, entry)
@@ -0,0 +1,184 @@
+import bisect
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+from inventory import InventoryIndex
+
+Z_INDEX = re.compile(r"Z(\d+)")
+DIGITS = re.compile(r"(\d+)")
+
+
+def z_index(path: Union[str, Path]) -> Optional[int]:
+    """Return the last Z number in a plane's name, e.g. 990 for Z0990.tif."""
+    matches = Z_INDEX.findall(Path(path).stem)
+    return int(matches[-1]) if matches else None
+
+
+def natural_key(name: str) -> tuple:
+    """Sort key ordering the numbers in `name` by value, "Z99" < "Z0100"."""
+    return tuple(
+        (1, int(part), part) if part.isdigit() else (0, 0, part)
+        for part in DIGITS.split(name)
+    )
+
+
+def format_ranges(values: Sequence[int]) -> str:
+    """Format sorted integers as "3, 7-9"."""
+    ranges = []
+    start = previous = values[0]
+    for value in list(values[1:]) + [None]:
+        if value is not None and value == previous + 1:
+            previous = value
+            continue
+        if start == previous:
+            ranges.append(f"{start}")
+        else:
+            ranges.append(f"{start}-{previous}")
+        if value is not None:
+            start = previous = value
+    return ", ".join(ranges)
+
+
+class PlaneSequence:
+    """
+    Single-plane TIFF files ordered by the Z index in their names.
+
+    Z numbers are compared by value, so Z0990.tif and Z00990.tif are the
+    same plane and Z0999.tif comes before Z01000.tif whatever the
+    zero-padding. Planes without a Z number are kept after the indexed
+    ones, in natural order. Once built, any Z range is looked up without
+    listing the directory again.
+
+    Parameters
+    ----------
+    tif_files : Sequence[str or Path]
+        Plane files, in any order
+    """
+
+    def __init__(self, tif_files: Sequence[Union[str, Path]]):
+        planes = [(z_index(path), Path(path)) for path in tif_files]
+        indexed = sorted(
+            (item for item in planes if item[0] is not None),
+            key=lambda item: (item[0], natural_key(item[1].name)),
+        )
+        self.unindexed: list[Path] = sorted(
+            (path for z, path in planes if z is None),
+            key=lambda path: natural_key(path.name),
+        )
+        self.z: list[int] = [z for z, _ in indexed]
+        self.files: list[Path] = [path for _, path in indexed]
+        self.files += self.unindexed
+        # set by from_directory, only used in messages
+        self.directory: Optional[Path] = None
+        self._by_z: dict[int, Path] = {}
+        for z, path in indexed:
+            self._by_z.setdefault(z, path)
+
+    @classmethod
+    def from_directory(
+        cls,
+        directory: Union[str, Path],
+        pattern: str = "*.tif",
+        index: Optional[InventoryIndex] = None,
+    ) -> "PlaneSequence":
+        """
+        List the planes of a directory once.
+
+        Parameters
+        ----------
+        directory : str or Path
+            Plane directory
+        pattern : str, optional
+            Glob pattern of the planes (default: "*.tif")
+        index : InventoryIndex, optional
+            Inventory the directory is listed from instead of the filesystem
+        """
+        if index is not None:
+            sequence = cls(index.glob(directory, pattern))
+        else:
+            sequence = cls(list(Path(directory).glob(pattern)))
+        sequence.directory = Path(directory)
+        return sequence
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator[Path]:
+        return iter(self.files)
+
+    def __contains__(self, z: int) -> bool:
+        return z in self._by_z
+
+    def __getitem__(self, z: int) -> Path:
+        """Return the plane of Z index `z`, the first one if duplicated."""
+        return self._by_z[z]
+
+    def select(
+        self, z_start: Optional[int] = None, z_stop: Optional[int] = None
+    ) -> list[Path]:
+        """
+        Return the planes with z_start <= Z index < z_stop, in Z order.
+
+        Parameters
+        ----------
+        z_start : int, optional
+            First Z index (default: the first plane)
+        z_stop : int, optional
+            Z index after the last one (default: after the last plane)
+        """
+        start = 0
+        if z_start is not None:
+            start = bisect.bisect_left(self.z, z_start)
+        stop = len(self.z)
+        if z_stop is not None:
+            stop = bisect.bisect_left(self.z, z_stop)
+        return self.files[start:stop]
+
+    def duplicates(self) -> list[int]:
+        """Return the Z indices shared by several planes."""
+        return sorted(
+            z for z, count in Counter(self.z).items() if count > 1
+        )
+
+    def gaps(self) -> list[int]:
+        """Return the Z indices missing between the first and last plane."""
+        if not self.z:
+            return []
+        return [
+            z for z in range(self.z[0], self.z[-1] + 1) if z not in self._by_z
+        ]
+
+    def pair(self, other: "PlaneSequence") -> list[tuple[Path, Path]]:
+        """
+        Pair every plane with the plane of the same Z index in `other`.
+
+        Parameters
+        ----------
+        other : PlaneSequence
+            Planes of another directory, e.g. with different zero-padding
+
+        Returns
+        -------
+        list[tuple[Path, Path]]
+            (plane, plane of other) pairs in Z order
+
+        Raises
+        ------
+        FileNotFoundError
+            If a plane has no counterpart in `other`
+        ValueError
+            If a plane has no Z index
+        """
+        if self.unindexed:
+            raise ValueError(f"{self.unindexed[0]} has no Z index")
+        pairs = []
+        for z, path in zip(self.z, self.files):
+            if z not in other:
+                raise FileNotFoundError(
+                    f"No counterpart of {path} in "
+                    f"{other.directory or 'the other sequence'}"
+                )
+            pairs.append((path, other[z]))
+        return pairs
@@ -0,0 +1,39 @@
+import contextlib
+from collections import Counter
+from typing import Iterator
+from unittest import mock
+
+import tifffile
+
+
+@contextlib.contextmanager
+def count_tiff_calls() -> Iterator[Counter]:
+    """
+    Count the TIFF files opened, pages parsed and pages decoded in a block.
+
+    Yields a Counter of "open" (TiffFile), "parse" (TiffPage IFDs read)
+    and "decode" (TiffPage.asarray) calls.
+    """
+    counts: Counter = Counter()
+
+    def counted(name, method):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    with mock.patch.object(
+        tifffile.TiffFile,
+        "__init__",
+        counted("open", tifffile.TiffFile.__init__),
+    ), mock.patch.object(
+        tifffile.TiffPage,
+        "__init__",
+        counted("parse", tifffile.TiffPage.__init__),
+    ), mock.patch.object(
+        tifffile.TiffPage,
+        "asarray",
+        counted("decode", tifffile.TiffPage.asarray),
+    ):
+        yield counts
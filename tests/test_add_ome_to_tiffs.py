@@ -0,0 +1,120 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from add_ome_to_tiffs import _copy_segments, add_ome_metadata
+from call_counts import count_tiff_calls
+
+
+class AddOmeMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        self.stack = rng.integers(0, 4000, (12, 64, 48), dtype=np.uint16)
+
+    def _write_input(self, name: str, **options) -> Path:
+        input_path = self.root.joinpath(name)
+        tifffile.imwrite(
+            input_path, self.stack, photometric="minisblack", **options
+        )
+        return input_path
+
+    def _assert_copied(self, input_path: Path, output_path: Path):
+        """Check the output holds the input pixels in the input encoding."""
+        with tifffile.TiffFile(input_path) as src, tifffile.TiffFile(
+            output_path
+        ) as out:
+            self.assertTrue(out.is_ome)
+            self.assertEqual(len(out.pages), len(src.pages))
+            np.testing.assert_array_equal(out.asarray(), self.stack)
+            first_in, first_out = src.pages.first, out.pages.first
+            for attr in ("compression", "predictor", "tile", "rowsperstrip"):
+                self.assertEqual(
+                    getattr(first_out, attr), getattr(first_in, attr)
+                )
+            for page_in, page_out in zip(src.pages, out.pages):
+                self.assertEqual(
+                    page_out.databytecounts, page_in.databytecounts
+                )
+
+    def test_raw_copy(self):
+        layouts = {
+            "stripped": {"rowsperstrip": 16},
+            "tiled": {"tile": (32, 32)},
+        }
+        for layout, options in layouts.items():
+            with self.subTest(layout=layout):
+                input_path = self._write_input(
+                    f"{layout}.tif",
+                    compression="zlib",
+                    predictor=True,
+                    **options,
+                )
+                output_path = self.root.joinpath(f"{layout}.ome.tif")
+                self.assertTrue(
+                    _copy_segments(input_path, output_path, {"axes": "ZYX"})
+                )
+                self._assert_copied(input_path, output_path)
+                # add_ome_metadata copies the segments without decoding
+                output_path.unlink()
+                with count_tiff_calls() as counts:
+                    add_ome_metadata(input_path, output_path, "original")
+                self.assertEqual(counts["decode"], 0)
+                self._assert_copied(input_path, output_path)
+
+    def test_raw_copy_declines_other_compressions(self):
+        input_path = self._write_input("lzw.tif", compression="lzw")
+        output_path = self.root.joinpath("lzw.ome.tif")
+        self.assertFalse(
+            _copy_segments(input_path, output_path, {"axes": "ZYX"})
+        )
+        self.assertFalse(output_path.exists())
+
+    def test_reencoding_reads_every_page_once(self):
+        # uncompressed input cannot be raw-copied, so every page is decoded
+        # once from a fixed number of open files, however many pages
+        opened = set()
+        for n_pages in (10, 40):
+            input_path = self.root.joinpath(f"mask_{n_pages}.tif")
+            output_path = self.root.joinpath(f"mask_{n_pages}.ome.tif")
+            stack = np.zeros((n_pages, 64, 64), np.uint8)
+            stack[::3, 10:20, 30:40] = 255
+            tifffile.imwrite(input_path, stack)
+            with count_tiff_calls() as counts:
+                add_ome_metadata(input_path, output_path, "original")
+            opened.add(counts["open"])
+            self.assertEqual(counts["decode"], n_pages)
+            self.assertLessEqual(counts["parse"], n_pages + counts["open"])
+            np.testing.assert_array_equal(
+                tifffile.imread(output_path), stack
+            )
+        self.assertEqual(len(opened), 1)
+
+    def test_tiled_pyramid(self):
+        input_path = self._write_input("stack.tif")
+        output_path = self.root.joinpath("stack.ome.tif")
+        add_ome_metadata(
+            input_path,
+            output_path,
+            "original",
+            tile=(32, 32),
+            levels=1,
+            kernel="max",
+        )
+        with tifffile.TiffFile(output_path) as tif:
+            self.assertTrue(tif.is_ome)
+            self.assertEqual(tif.pages.first.tile, (32, 32))
+            levels = tif.series[0].levels
+            self.assertEqual(len(levels), 2)
+            np.testing.assert_array_equal(levels[0].asarray(), self.stack)
+            reduced = self.stack.reshape(12, 32, 2, 24, 2).max(axis=(2, 4))
+            np.testing.assert_array_equal(levels[1].asarray(), reduced)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import psutil
+import tifffile
+
+from call_counts import count_tiff_calls
+from tiff_readers import iter_page_slabs, probe_page_stack, read_page_stack
+
+
+class PageReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        self.stack = rng.integers(0, 255, (37, 48, 40), dtype=np.uint8)
+        self.path = self.root.joinpath("stack.tif")
+        tifffile.imwrite(self.path, self.stack, rowsperstrip=8)
+
+    def test_iter_page_slabs(self):
+        for slab_depth in (1, 5, 64):
+            slabs = list(iter_page_slabs(self.path, slab_depth))
+            self.assertTrue(all(len(slab) <= slab_depth for slab in slabs))
+            np.testing.assert_array_equal(np.concatenate(slabs), self.stack)
+
+    def test_iter_page_slabs_subset(self):
+        slabs = list(
+            iter_page_slabs(
+                self.path,
+                4,
+                np.uint16,
+                page_range=(3, 30),
+                roi=(5, 21, 10, 100),
+            )
+        )
+        subset = np.concatenate(slabs)
+        self.assertEqual(subset.dtype, np.uint16)
+        np.testing.assert_array_equal(subset, self.stack[3:30, 5:21, 10:])
+        self.assertEqual(
+            probe_page_stack(
+                self.path, np.uint16, (3, 30), (5, 21, 10, 100)
+            ),
+            (subset.shape, np.dtype(np.uint16)),
+        )
+
+    def test_read_page_stack(self):
+        stack = read_page_stack(self.path, pages_per_chunk=8)
+        self.assertEqual(stack.chunks[0], (8, 8, 8, 8, 5))
+        np.testing.assert_array_equal(stack.compute(), self.stack)
+        subset = read_page_stack(
+            self.path,
+            dtype=np.float32,
+            page_range=(10, 20),
+            roi=(0, 16, 8, 24),
+        )
+        self.assertEqual(subset.dtype, np.float32)
+        np.testing.assert_array_equal(
+            subset.compute(), self.stack[10:20, :16, 8:24]
+        )
+        # every chunk closes the file it opened
+        open_files = [f.path for f in psutil.Process().open_files()]
+        self.assertNotIn(str(self.path), open_files)
+
+    def test_iter_page_slabs_reads_every_page_once(self):
+        # one open file and one IFD read per page, not a walk of the IFD
+        # chain per page
+        for n_pages in (10, 40):
+            path = self.root.joinpath(f"pages_{n_pages}.tif")
+            tifffile.imwrite(path, np.zeros((n_pages, 16, 16), np.uint8))
+            with count_tiff_calls() as counts:
+                slabs = list(iter_page_slabs(path, 3))
+            self.assertEqual(sum(len(slab) for slab in slabs), n_pages)
+            self.assertEqual(
+                counts, {"open": 1, "parse": n_pages, "decode": n_pages}
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,301 @@
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+import dask
+import dask.array as da
+import numpy as np
+import tifffile
+import zarr
+
+from plane_sequence import PlaneSequence
+
+# (y_start, y_stop, x_start, x_stop) pixel bounds of a region of interest
+ROI = tuple[int, int, int, int]
+
+
+def roi_window(roi: Optional[ROI], plane_shape: tuple) -> tuple[slice, slice]:
+    """
+    Clip a region of interest to (y, x) slices of a plane.
+
+    Parameters
+    ----------
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop), None for the whole plane
+    plane_shape : tuple
+        YX shape of the plane
+    """
+    if roi is None:
+        return slice(0, plane_shape[0]), slice(0, plane_shape[1])
+    window = tuple(
+        slice(*slice(start, stop).indices(size)[:2])
+        for start, stop, size in zip(roi[::2], roi[1::2], plane_shape)
+    )
+    if any(part.stop <= part.start for part in window):
+        raise ValueError(f"ROI {roi} is empty in planes of {plane_shape}")
+    return window
+
+
+def read_window(
+    tif_path: Union[str, Path], window: Optional[tuple[slice, ...]] = None
+) -> np.ndarray:
+    """
+    Decode a window of a TIFF, only reading the strips or tiles it overlaps.
+
+    Parameters
+    ----------
+    tif_path : str or Path
+        TIFF file
+    window : tuple[slice, ...], optional
+        Slices of the first series, e.g. (y, x) of a plane or (z, y, x) of
+        a stack (default: None, the whole series)
+    """
+    if window is None:
+        return tifffile.imread(tif_path)
+    with tifffile.imread(tif_path, aszarr=True) as store:
+        return zarr.open(store, mode="r")[window]
+
+
+def _read_planes(
+    tif_files: Sequence[Path],
+    dtype: np.dtype,
+    window: Optional[tuple[slice, slice]] = None,
+) -> np.ndarray:
+    """Decode and stack single-plane TIFF files."""
+    return np.stack(
+        [read_window(tif_file, window) for tif_file in tif_files]
+    ).astype(dtype, copy=False)
+
+
+def _read_pages(
+    tif_path: Path,
+    start: int,
+    stop: int,
+    dtype: np.dtype,
+    window: Optional[tuple[slice, slice]] = None,
+    is_page_series: bool = False,
+) -> np.ndarray:
+    """Decode and stack pages [start, stop) of a multi-page TIFF."""
+    if window is not None and is_page_series:
+        # only the strips or tiles overlapping the window are decoded
+        return read_window(tif_path, (slice(start, stop), *window)).astype(
+            dtype, copy=False
+        )
+    with tifffile.TiffFile(tif_path) as tif:
+        pages = np.stack([page.asarray() for page in tif.pages[start:stop]])
+    if window is not None:
+        pages = pages[(slice(None), *window)]
+    return pages.astype(dtype, copy=False)
+
+
+def _page_layout(
+    tif: tifffile.TiffFile,
+    dtype: Union[np.dtype, None] = None,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+) -> tuple[int, int, Optional[tuple[slice, slice]], tuple, np.dtype]:
+    """Return the first and last page, YX window, ZYX shape and dtype."""
+    n_pages = len(tif.pages)
+    page_shape = tif.pages[0].shape
+    dtype = np.dtype(dtype or tif.pages[0].dtype)
+    first, last = 0, n_pages
+    if page_range is not None:
+        first, last = slice(*page_range).indices(n_pages)[:2]
+        if last <= first:
+            raise ValueError(f"No pages of {tif.filename} in {page_range}")
+    window = None
+    if roi is not None:
+        window = roi_window(roi, page_shape)
+        page_shape = tuple(part.stop - part.start for part in window)
+    return first, last, window, (last - first, *page_shape), dtype
+
+
+def _is_page_series(tif: tifffile.TiffFile) -> bool:
+    """Whether the first series of `tif` is all of its pages, stacked."""
+    return tif.series[0].shape == (len(tif.pages), *tif.pages[0].shape)
+
+
+def probe_page_stack(
+    tif_path: Union[str, Path],
+    dtype: Union[np.dtype, None] = None,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+) -> tuple[tuple, np.dtype]:
+    """
+    Return the ZYX shape and dtype iter_page_slabs yields, from the header.
+
+    Parameters
+    ----------
+    tif_path : str or Path
+        Multi-page TIFF
+    dtype : np.dtype, optional
+        Data type of the slabs, defaults to the dtype of the first page
+    page_range : tuple[int, int], optional
+        (start, stop) pages (default: None, every page)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of every page
+        (default: None, whole pages)
+    """
+    with tifffile.TiffFile(tif_path) as tif:
+        _, _, _, shape, dtype = _page_layout(tif, dtype, page_range, roi)
+    return shape, dtype
+
+
+def iter_page_slabs(
+    tif_path: Union[str, Path],
+    slab_depth: int = 1,
+    dtype: Union[np.dtype, None] = None,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Decode the pages of a multi-page TIFF slab by slab, in page order.
+
+    The file is opened once and its IFD chain walked once, so streaming a
+    stack costs the same per page however many pages it has. Sequential
+    consumers, e.g. writers taking one slab at a time, should use this
+    rather than slicing read_page_stack.
+
+    Parameters
+    ----------
+    tif_path : str or Path
+        Multi-page TIFF, e.g. a FRSTseg mask or a heatmap stack
+    slab_depth : int, optional
+        Number of pages per slab, the last slab may be shorter (default: 1)
+    dtype : np.dtype, optional
+        Data type of the slabs, defaults to the dtype of the first page
+    page_range : tuple[int, int], optional
+        (start, stop) pages to decode (default: None, every page)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of every page, only the
+        strips or tiles overlapping it are decoded (default: None)
+
+    Yields
+    ------
+    np.ndarray
+        ZYX slabs of up to `slab_depth` pages
+    """
+    with tifffile.TiffFile(tif_path) as tif:
+        first, last, window, _, dtype = _page_layout(
+            tif, dtype, page_range, roi
+        )
+        pages = None
+        if window is not None and _is_page_series(tif):
+            pages = zarr.open(tif.aszarr(), mode="r")
+        for start in range(first, last, slab_depth):
+            stop = min(start + slab_depth, last)
+            if pages is not None:
+                slab = pages[(slice(start, stop), *window)]
+            else:
+                slab = np.stack(
+                    [page.asarray() for page in tif.pages[start:stop]]
+                )
+                if window is not None:
+                    slab = slab[(slice(None), *window)]
+            yield slab.astype(dtype, copy=False)
+
+
+def read_plane_stack(
+    tif_files: Union[str, Path, Sequence[Path]],
+    pattern: str = "*.tif",
+    planes_per_chunk: int = 1,
+    dtype: Union[np.dtype, None] = None,
+    roi: Optional[ROI] = None,
+) -> da.Array:
+    """
+    Expose a sequence of single-plane TIFF files as a lazy ZYX dask array.
+
+    Only the header of the first file is read up front, every chunk of
+    `planes_per_chunk` planes is decoded when it is computed. With a region
+    of interest, only the strips or tiles overlapping it are decoded.
+
+    Parameters
+    ----------
+    tif_files : str, Path or Sequence[Path]
+        Directory of planes, ordered by the Z index of their names, or the
+        planes themselves in Z order
+    pattern : str, optional
+        Glob pattern matching the planes when a directory is given
+        (default: "*.tif")
+    planes_per_chunk : int, optional
+        Number of planes per dask chunk (default: 1)
+    dtype : np.dtype, optional
+        Data type of the array, defaults to the dtype of the first plane
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of every plane
+        (default: None, whole planes)
+    """
+    if isinstance(tif_files, (str, Path)):
+        tif_files = PlaneSequence.from_directory(tif_files, pattern).files
+    if not tif_files:
+        raise ValueError("No TIFF files to read")
+    with tifffile.TiffFile(tif_files[0]) as tif:
+        plane_shape = tif.pages[0].shape
+        dtype = np.dtype(dtype or tif.pages[0].dtype)
+    window = None
+    if roi is not None:
+        window = roi_window(roi, plane_shape)
+        plane_shape = tuple(part.stop - part.start for part in window)
+
+    blocks = []
+    for start in range(0, len(tif_files), planes_per_chunk):
+        block_files = list(tif_files[start : start + planes_per_chunk])
+        blocks.append(
+            da.from_delayed(
+                dask.delayed(_read_planes)(block_files, dtype, window),
+                shape=(len(block_files), *plane_shape),
+                dtype=dtype,
+            )
+        )
+    return da.concatenate(blocks, axis=0)
+
+
+def read_page_stack(
+    tif_path: Union[str, Path],
+    pages_per_chunk: int = 16,
+    dtype: Union[np.dtype, None] = None,
+    page_range: Optional[tuple[int, int]] = None,
+    roi: Optional[ROI] = None,
+) -> da.Array:
+    """
+    Expose the pages of a multi-page TIFF stack as a lazy ZYX dask array.
+
+    Every chunk of `pages_per_chunk` pages opens the file, decodes its pages
+    and closes it again, so no file handle outlives a compute. Only the
+    pages in `page_range` are exposed and, with a region of interest, only
+    the strips or tiles overlapping it are decoded. To stream a stack in
+    order, iter_page_slabs avoids building and slicing a task graph per
+    slab.
+
+    Parameters
+    ----------
+    tif_path : str or Path
+        Multi-page TIFF, e.g. a FRSTseg mask or a heatmap stack
+    pages_per_chunk : int, optional
+        Number of pages per dask chunk (default: 16)
+    dtype : np.dtype, optional
+        Data type of the array, defaults to the dtype of the first page
+    page_range : tuple[int, int], optional
+        (start, stop) pages to expose (default: None, every page)
+    roi : tuple[int, int, int, int], optional
+        (y_start, y_stop, x_start, x_stop) crop of every page
+        (default: None, whole pages)
+    """
+    tif_path = Path(tif_path)
+    with tifffile.TiffFile(tif_path) as tif:
+        first, last, window, shape, dtype = _page_layout(
+            tif, dtype, page_range, roi
+        )
+        is_page_series = _is_page_series(tif)
+    blocks = []
+    for start in range(first, last, pages_per_chunk):
+        stop = min(start + pages_per_chunk, last)
+        blocks.append(
+            da.from_delayed(
+                dask.delayed(_read_pages)(
+                    tif_path, start, stop, dtype, window, is_page_series
+                ),
+                shape=(stop - start, *shape[1:]),
+                dtype=dtype,
+            )
+        )
+    return da.concatenate(blocks, axis=0)
@@ -0,0 +1,238 @@
+import argparse
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+from inventory import InventoryIndex, probe_tiff
+from plane_sequence import PlaneSequence, format_ranges, z_index
+
+# header facts every plane of a stack must share
+PLANE_FACTS: tuple[str, ...] = (
+    "shape",
+    "dtype",
+    "bitspersample",
+    "compression",
+    "pages",
+)
+# anomalies listed in the error raised by check_planes
+MAX_REPORTED: int = 20
+
+
+def probe_planes(
+    tif_files: Sequence[Union[str, Path]],
+    max_workers: int = 32,
+    index: Optional[InventoryIndex] = None,
+) -> list[dict]:
+    """
+    Read the header facts of every plane, without decoding pixels.
+
+    Parameters
+    ----------
+    tif_files : Sequence[str or Path]
+        Plane files
+    max_workers : int, optional
+        Number of headers read concurrently (default: 32)
+    index : InventoryIndex, optional
+        Inventory the facts of unchanged files are taken from
+
+    Returns
+    -------
+    list[dict]
+        probe_tiff facts of each plane, in order
+    """
+    if index is not None:
+        return index.tiff_infos(tif_files, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(probe_tiff, tif_files))
+
+
+def z_anomalies(tif_files: Sequence[Union[str, Path]]) -> list[str]:
+    """
+    Check that the Z indices of ordered planes are contiguous and ascending.
+
+    Planes without a Z number in their name are only reported when other
+    planes of the sequence have one.
+
+    Parameters
+    ----------
+    tif_files : Sequence[str or Path]
+        Plane files in the order they are stacked
+    """
+    sequence = PlaneSequence(tif_files)
+    if not sequence.z:
+        return []
+    anomalies = [
+        f"{tif_file.name}: no Z index in the name"
+        for tif_file in sequence.unindexed
+    ]
+    duplicates = sequence.duplicates()
+    if duplicates:
+        anomalies.append(f"duplicate Z indices: {format_ranges(duplicates)}")
+    missing = sequence.gaps()
+    if missing:
+        anomalies.append(f"missing Z indices: {format_ranges(missing)}")
+    indices = [z_index(tif_file) for tif_file in tif_files]
+    indices = [z for z in indices if z is not None]
+    if any(later < earlier for earlier, later in zip(indices, indices[1:])):
+        anomalies.append(
+            "planes are not in ascending Z order, e.g. mixed zero-padding"
+        )
+    return anomalies
+
+
+def validate_planes(
+    tif_files: Sequence[Union[str, Path]],
+    max_workers: int = 32,
+    index: Optional[InventoryIndex] = None,
+) -> tuple[dict, list[str]]:
+    """
+    Check that a plane sequence can be stacked, reading headers only.
+
+    Every plane is compared with the most common header facts of the
+    sequence, and the Z indices of the names are checked with z_anomalies.
+
+    Parameters
+    ----------
+    tif_files : Sequence[str or Path]
+        Plane files in the order they are stacked
+    max_workers : int, optional
+        Number of headers read concurrently (default: 32)
+    index : InventoryIndex, optional
+        Inventory the facts of unchanged files are taken from
+
+    Returns
+    -------
+    tuple[dict, list[str]]
+        The most common facts of PLANE_FACTS, and one message per anomaly
+    """
+    if not tif_files:
+        raise ValueError("No TIFF files to validate")
+    infos = probe_planes(tif_files, max_workers, index)
+    reference = {}
+    anomalies = []
+    for fact in PLANE_FACTS:
+        values = [
+            tuple(info[fact]) if fact == "shape" else info[fact]
+            for info in infos
+        ]
+        reference[fact] = Counter(values).most_common(1)[0][0]
+        anomalies.extend(
+            f"{Path(tif_file).name}: {fact} {value} instead of "
+            f"{reference[fact]}"
+            for tif_file, value in zip(tif_files, values)
+            if value != reference[fact]
+        )
+    anomalies.extend(z_anomalies(tif_files))
+    return reference, anomalies
+
+
+def check_planes(
+    tif_files: Sequence[Union[str, Path]],
+    max_workers: int = 32,
+    index: Optional[InventoryIndex] = None,
+    strict: bool = True,
+) -> dict:
+    """
+    Validate a plane sequence and report the anomalies that would keep it
+    from being stacked as is.
+
+    Parameters
+    ----------
+    tif_files : Sequence[str or Path]
+        Plane files in the order they are stacked
+    max_workers : int, optional
+        Number of headers read concurrently (default: 32)
+    index : InventoryIndex, optional
+        Inventory the facts of unchanged files are taken from
+    strict : bool, optional
+        Raise on anomalies instead of printing them as a warning
+        (default: True)
+
+    Returns
+    -------
+    dict
+        The facts shared by most planes, e.g. "shape" and "dtype"
+
+    Raises
+    ------
+    ValueError
+        If strict and any plane differs from the others or the Z indices
+        are not contiguous
+    """
+    reference, anomalies = validate_planes(tif_files, max_workers, index)
+    if anomalies:
+        listed = "\n".join(anomalies[:MAX_REPORTED])
+        more = len(anomalies) - MAX_REPORTED
+        if more > 0:
+            listed += f"\n... and {more} more"
+        message = (
+            f"{len(anomalies)} anomalies in the planes of "
+            f"{Path(tif_files[0]).parent}:\n{listed}"
+        )
+        if strict:
+            raise ValueError(message)
+        print(f"Warning: {message}")
+    return reference
+
+
+def main():
+    """
+    Validate plane directories and exit with 1 if any has anomalies.
+    """
+    parser = argparse.ArgumentParser(
+        description="Validate TIFF plane directories from their headers."
+    )
+    parser.add_argument("dirs", type=str, nargs="+", help="Plane directories")
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default="*.tif",
+        help="Glob pattern of the planes (default: *.tif)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=32,
+        help="Number of headers read concurrently (default: 32)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=None,
+        help="SQLite inventory index the headers are cached in",
+    )
+    args = parser.parse_args()
+    index = None
+    if args.inventory is not None:
+        index = InventoryIndex(args.inventory)
+    failed = False
+    try:
+        for plane_dir in args.dirs:
+            tif_files = PlaneSequence.from_directory(
+                plane_dir, args.pattern, index
+            ).files
+            if not tif_files:
+                print(f"{plane_dir}: no files matching {args.pattern}")
+                failed = True
+                continue
+            reference, anomalies = validate_planes(
+                tif_files, args.workers, index
+            )
+            print(
+                f"{plane_dir}: {len(tif_files)} planes of "
+                f"{reference['shape']} {reference['dtype']}, "
+                f"{len(anomalies)} anomalies"
+            )
+            for anomaly in anomalies:
+                print(f"  {anomaly}")
+            failed = failed or bool(anomalies)
+    finally:
+        if index is not None:
+            index.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
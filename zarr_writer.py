@@ -0,0 +1,415 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from ome_zarr.format import CurrentFormat
+from ome_zarr.writer import write_multiscales_metadata
+from skimage.transform import resize
+from tqdm import tqdm
+
+import instrumentation
+
+DEFAULT_CHUNKS: tuple[int, int, int] = (16, 512, 512)
+KERNELS: tuple[str, ...] = ("linear", "nearest", "mean", "max", "mode")
+SHUFFLES: dict[str, int] = {
+    "noshuffle": Blosc.NOSHUFFLE,
+    "shuffle": Blosc.SHUFFLE,
+    "bitshuffle": Blosc.BITSHUFFLE,
+}
+
+
+def make_storage_options(
+    chunks: Sequence[int] = DEFAULT_CHUNKS,
+    cname: str = "zstd",
+    clevel: int = 5,
+    shuffle: str = "bitshuffle",
+) -> dict:
+    """
+    Build the storage options of one layer: its chunks and Blosc compressor.
+
+    The dict has the "chunks" and "compressor" keys of the ``storage_options``
+    taken by ``ome_zarr.writer.write_image``.
+
+    Parameters
+    ----------
+    chunks : Sequence[int], optional
+        ZYX chunk shape (default: DEFAULT_CHUNKS)
+    cname : str, optional
+        Blosc codec, e.g. "zstd" or "lz4" (default: "zstd")
+    clevel : int, optional
+        Compression level from 0 to 9 (default: 5)
+    shuffle : str, optional
+        "noshuffle", "shuffle" or "bitshuffle" (default: "bitshuffle")
+    """
+    if len(chunks) != 3:
+        raise ValueError(f"Expected ZYX chunks, got {tuple(chunks)}")
+    if shuffle not in SHUFFLES:
+        raise ValueError(
+            f"Unknown shuffle {shuffle!r}, expected one of {tuple(SHUFFLES)}"
+        )
+    return {
+        "chunks": tuple(int(chunk) for chunk in chunks),
+        "compressor": Blosc(
+            cname=cname, clevel=clevel, shuffle=SHUFFLES[shuffle]
+        ),
+    }
+
+
+def _block_view(slab: np.ndarray, downscale: int) -> np.ndarray:
+    """Crop YX to a multiple of `downscale` and expose every YX block."""
+    out_y = slab.shape[-2] // downscale
+    out_x = slab.shape[-1] // downscale
+    cropped = slab[..., : out_y * downscale, : out_x * downscale]
+    blocks = cropped.reshape(
+        *slab.shape[:-2], out_y, downscale, out_x, downscale
+    )
+    # (..., out_y, out_x, downscale * downscale)
+    return np.moveaxis(blocks, -3, -2).reshape(
+        *slab.shape[:-2], out_y, out_x, downscale * downscale
+    )
+
+
+def _block_mode(blocks: np.ndarray) -> np.ndarray:
+    """Most frequent value of the last axis, ties go to the first one."""
+    counts = np.stack(
+        [
+            (blocks == blocks[..., i : i + 1]).sum(axis=-1)
+            for i in range(blocks.shape[-1])
+        ],
+        axis=-1,
+    )
+    winner = np.argmax(counts, axis=-1)[..., np.newaxis]
+    return np.take_along_axis(blocks, winner, axis=-1)[..., 0]
+
+
+def downsample_slab(
+    slab: np.ndarray, downscale: int = 2, kernel: str = "linear"
+) -> np.ndarray:
+    """
+    Downsample the last two (YX) axes of a slab.
+
+    "linear" and "nearest" mirror ``ome_zarr.scale.Scaler``, which
+    ``write_image`` uses for dask and numpy arrays respectively. "mean",
+    "max" and "mode" reduce every `downscale` x `downscale` block, for
+    intensity images, sparse masks and label volumes respectively.
+
+    Parameters
+    ----------
+    slab : np.ndarray
+        Array whose last two axes are Y and X
+    downscale : int, optional
+        Factor by which Y and X are reduced (default: 2)
+    kernel : str, optional
+        One of KERNELS (default: "linear")
+    """
+    if kernel not in KERNELS:
+        raise ValueError(
+            f"Unknown kernel {kernel!r}, expected one of {KERNELS}"
+        )
+    if kernel in ("linear", "nearest"):
+        out_shape = (
+            *slab.shape[:-2],
+            slab.shape[-2] // downscale,
+            slab.shape[-1] // downscale,
+        )
+        return resize(
+            slab.astype(float),
+            out_shape,
+            order=1 if kernel == "linear" else 0,
+            mode="reflect",
+            anti_aliasing=False,
+        ).astype(slab.dtype)
+    blocks = _block_view(slab, downscale)
+    if kernel == "max":
+        return blocks.max(axis=-1)
+    if kernel == "mode":
+        return _block_mode(blocks)
+    reduced = blocks.mean(axis=-1)
+    if np.issubdtype(slab.dtype, np.integer):
+        reduced = np.round(reduced)
+    return reduced.astype(slab.dtype)
+
+
+def create_pyramid(
+    group: zarr.Group,
+    shape: tuple,
+    dtype: np.dtype,
+    chunks: tuple = DEFAULT_CHUNKS,
+    max_layer: int = 4,
+    downscale: int = 2,
+    compressor="default",
+) -> list[zarr.Array]:
+    """
+    Create empty zarr arrays for every level of a multiscale pyramid.
+
+    Parameters
+    ----------
+    group : zarr.Group
+        Group the pyramid levels are created in, as "0", "1", ...
+    shape : tuple
+        Full resolution shape, the last three axes are ZYX
+    dtype : np.dtype
+        Data type of every level
+    chunks : tuple, optional
+        Chunk shape of the last three (ZYX) axes, leading axes are chunked
+        by 1 (default: DEFAULT_CHUNKS)
+    max_layer : int, optional
+        Number of downsampled levels below full resolution (default: 4)
+    downscale : int, optional
+        YX reduction factor between consecutive levels (default: 2)
+    compressor : numcodecs codec, optional
+        Compressor of every level, None for uncompressed (default: zarr's
+        default compressor)
+    """
+    arrays = []
+    level_shape = tuple(shape)
+    for level in range(max_layer + 1):
+        if level > 0:
+            level_shape = (
+                *level_shape[:-2],
+                level_shape[-2] // downscale,
+                level_shape[-1] // downscale,
+            )
+        level_chunks = (1,) * (len(level_shape) - 3) + tuple(
+            max(1, min(chunk, dim))
+            for chunk, dim in zip(chunks, level_shape[-3:])
+        )
+        arrays.append(
+            group.create_dataset(
+                str(level),
+                shape=level_shape,
+                chunks=level_chunks,
+                dtype=dtype,
+                compressor=compressor,
+                overwrite=True,
+            )
+        )
+    return arrays
+
+
+def write_slab(
+    arrays: list[zarr.Array],
+    slab: np.ndarray,
+    z_start: int,
+    leading: tuple = (),
+    downscale: int = 2,
+    kernel: str = "linear",
+) -> None:
+    """
+    Write a ZYX slab into every level of a pyramid created by create_pyramid.
+
+    Parameters
+    ----------
+    arrays : list[zarr.Array]
+        Pyramid levels, full resolution first
+    slab : np.ndarray
+        ZYX block of full resolution planes
+    z_start : int
+        Z index of the first plane of the slab
+    leading : tuple, optional
+        Indices of any axes before Z, e.g. (channel,) for czyx (default: ())
+    downscale : int, optional
+        YX reduction factor between consecutive levels (default: 2)
+    kernel : str, optional
+        Downsampling kernel, one of KERNELS (default: "linear")
+    """
+    z_stop = z_start + slab.shape[0]
+    for level, array in enumerate(arrays):
+        if level > 0:
+            slab = downsample_slab(slab, downscale, kernel)
+        array[(*leading, slice(z_start, z_stop))] = slab
+
+
+def _chunk_regions(array: zarr.Array) -> list[tuple[slice, ...]]:
+    """Return the index of every chunk of a zarr array."""
+    return [
+        tuple(
+            slice(start, min(start + chunk, dim))
+            for start, chunk, dim in zip(starts, array.chunks, array.shape)
+        )
+        for starts in itertools.product(
+            *(
+                range(0, dim, chunk)
+                for dim, chunk in zip(array.shape, array.chunks)
+            )
+        )
+    ]
+
+
+def downsample_level(
+    source: zarr.Array,
+    target: zarr.Array,
+    kernel: str = "mean",
+    downscale: int = 2,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Fill a pyramid level from the level above it, one target chunk at a time.
+
+    Every target chunk is computed from its `downscale` x `downscale` YX
+    footprint in `source` on a thread pool, and no two tasks write the same
+    chunk.
+
+    Parameters
+    ----------
+    source : zarr.Array
+        Finished higher resolution level
+    target : zarr.Array
+        Level to fill, its YX shape is the source's divided by `downscale`
+    kernel : str, optional
+        Downsampling kernel, one of KERNELS (default: "mean")
+    downscale : int, optional
+        YX reduction factor between the levels (default: 2)
+    max_workers : int, optional
+        Number of threads (default: ThreadPoolExecutor's default)
+    """
+
+    def fill(region: tuple[slice, ...]) -> None:
+        footprint = (
+            *region[:-2],
+            *(
+                slice(part.start * downscale, part.stop * downscale)
+                for part in region[-2:]
+            ),
+        )
+        target[region] = downsample_slab(source[footprint], downscale, kernel)
+
+    regions = _chunk_regions(target)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in tqdm(executor.map(fill, regions), total=len(regions)):
+            pass
+
+
+def build_pyramid(
+    arrays: list[zarr.Array],
+    kernel: str = "mean",
+    downscale: int = 2,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Compute every downsampled level of a pyramid from the previous level.
+
+    Only the full resolution level has to be written beforehand, e.g. with
+    ``write_slab(arrays[:1], ...)``.
+
+    Parameters
+    ----------
+    arrays : list[zarr.Array]
+        Pyramid levels from create_pyramid, full resolution first
+    kernel : str, optional
+        Downsampling kernel, one of KERNELS (default: "mean")
+    downscale : int, optional
+        YX reduction factor between consecutive levels (default: 2)
+    max_workers : int, optional
+        Number of threads per level (default: ThreadPoolExecutor's default)
+    """
+    for source, target in zip(arrays[:-1], arrays[1:]):
+        downsample_level(source, target, kernel, downscale, max_workers)
+
+
+def write_pyramid_metadata(
+    group: zarr.Group,
+    arrays: list[zarr.Array],
+    axes: str,
+    translation: Optional[Sequence[float]] = None,
+) -> None:
+    """
+    Write the OME-Zarr multiscales metadata for a pyramid of zarr arrays.
+
+    Parameters
+    ----------
+    group : zarr.Group
+        Group holding the pyramid levels
+    arrays : list[zarr.Array]
+        Pyramid levels, full resolution first
+    axes : str
+        Axis names, e.g. "zyx" or "czyx"
+    translation : Sequence[float], optional
+        Origin of the image per axis, in full resolution voxels, e.g. the
+        offset of a subset within its source volume (default: None)
+    """
+    fmt = CurrentFormat()
+    shapes = [array.shape for array in arrays]
+    transformations = fmt.generate_coordinate_transformations(shapes)
+    if translation is not None:
+        for transformation in transformations:
+            transformation.append(
+                {
+                    "type": "translation",
+                    "translation": [float(t) for t in translation],
+                }
+            )
+    datasets = [
+        {"path": str(level), "coordinateTransformations": transformation}
+        for level, transformation in enumerate(transformations)
+    ]
+    write_multiscales_metadata(group, datasets, fmt, axes)
+
+
+def write_slabs(
+    slabs: Iterable[np.ndarray],
+    group: zarr.Group,
+    shape: tuple,
+    dtype: np.dtype,
+    axes: str = "zyx",
+    chunks: tuple = DEFAULT_CHUNKS,
+    max_layer: int = 4,
+    downscale: int = 2,
+    kernel: str = "mean",
+    compressor="default",
+    translation: Optional[Sequence[float]] = None,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Write ZYX slabs, in Z order, as an OME-Zarr multiscale image.
+
+    Each slab is written straight into the full resolution array, so memory
+    stays proportional to one slab, and the downsampled levels are then
+    built with build_pyramid. Slabs should span ``chunks[0]`` planes so
+    every chunk is written only once. Its time is split as described in
+    instrumentation.timed_write.
+
+    Parameters
+    ----------
+    slabs : Iterable[np.ndarray]
+        Consecutive ZYX blocks of planes covering the whole volume
+    group : zarr.Group
+        Group the image is written to
+    shape : tuple
+        ZYX shape of the full resolution volume
+    dtype : np.dtype
+        Data type of the volume
+    axes : str, optional
+        Axis names (default: "zyx")
+    chunks : tuple, optional
+        ZYX chunk shape (default: DEFAULT_CHUNKS)
+    max_layer : int, optional
+        Number of downsampled levels below full resolution (default: 4)
+    downscale : int, optional
+        YX reduction factor between consecutive levels (default: 2)
+    kernel : str, optional
+        Downsampling kernel, one of KERNELS (default: "mean")
+    compressor : numcodecs codec, optional
+        Compressor of every level (default: zarr's default compressor)
+    translation : Sequence[float], optional
+        Origin of the volume in full resolution voxels, see
+        write_pyramid_metadata (default: None)
+    max_workers : int, optional
+        Number of threads building each pyramid level, see build_pyramid
+        (default: ThreadPoolExecutor's default)
+    """
+    arrays = create_pyramid(
+        group, shape, dtype, chunks, max_layer, downscale, compressor
+    )
+    with instrumentation.timed_write(slabs) as slabs:
+        z_start = 0
+        for slab in slabs:
+            write_slab(arrays[:1], slab, z_start)
+            z_start += slab.shape[0]
+        if z_start != shape[0]:
+            raise ValueError(f"Slabs covered {z_start} of {shape[0]} planes")
+        build_pyramid(arrays, kernel, downscale, max_workers)
+        write_pyramid_metadata(group, arrays, axes, translation)